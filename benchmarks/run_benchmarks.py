@@ -0,0 +1,149 @@
+"""Time the pipeline stages on synthetic trees and score them against the ground truth.
+
+    python benchmarks/run_benchmarks.py --points 100000 1000000 --out bench.jsonl
+
+Every stage prints one line (and writes one JSON line with --out) with its
+run time, throughput and accuracy, so a speed-up that costs shoot-number,
+angle or length accuracy shows up next to the timing.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import importlib
+import numpy as np
+from scipy.spatial import cKDTree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+from synthetic import make_tree
+
+STAGES = ("trunk", "registration", "filter", "cluster", "measure")
+
+# Registration RMSE of the difference filters (threshold = x * RMSE)
+RMSE = 0.009
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bp_registered(tree):
+    # BP scan moved onto AP with the true transform
+    H = tree["H"]
+    return tree["BP"] @ H[:3, :3].T + H[:3, 3]
+
+
+def bench_trunk(tree, workdir):
+    Registration = importlib.import_module("Registration")
+    (_, trunk), seconds = timed(Registration.get_trunk, tree["BP"], 0.2, 0.03)
+    return [{"stage": "get_trunk", "seconds": seconds, "points": len(tree["BP"]),
+             "trunk_height_error_m": abs(trunk[:, 2].max() - tree["trunk_height"])}]
+
+
+def bench_registration(tree, workdir):
+    Registration = importlib.import_module("Registration")
+    Registration.OUT_EXT = ".npy"
+    for name in ("AP", "BP"):
+        os.makedirs(os.path.join(workdir, name), exist_ok=True)
+        np.save(os.path.join(workdir, name, "tree.npy"), tree[name])
+
+    records = []
+    for icp_method in ("pyramid", "simpleicp"):
+        _, seconds = timed(Registration.align_one, os.path.join(workdir, "AP", ""), os.path.join(workdir, "BP", ""),
+                           os.path.join(workdir, ""), "tree.npy", show=False, icp_method=icp_method, cache=False)
+        moved = np.load(os.path.join(workdir, "moved_tree.npy"))
+        # Distance of every moved BP point to where the true transform puts it (SOR drops a few)
+        error, _ = cKDTree(bp_registered(tree)).query(moved, workers=-1)
+        records.append({"stage": f"align_one ({icp_method})", "seconds": seconds, "points": len(tree["BP"]),
+                        "median_error_m": float(np.median(error)), "p95_error_m": float(np.percentile(error, 95))})
+    return records
+
+
+def new_points(tree, x=3):
+    # AP points with their shoot label, filtered against the registered BP scan
+    Distancefilter = importlib.import_module("Distancefilter&cluster")
+    B = np.column_stack((tree["AP"], tree["AP_labels"]))
+    return timed(Distancefilter.filter_points_with_kdtree, bp_registered(tree), B, x * RMSE)
+
+
+def bench_filter(tree, workdir):
+    new, seconds = new_points(tree)
+    added = {s["label"] for s in tree["shoots"] if s["status"] == "added"}
+    is_added = np.isin(new[:, -1], list(added))
+    return [{"stage": "filter_points_with_kdtree", "seconds": seconds, "points": len(tree["AP"]),
+             "precision": float(is_added.mean()) if len(new) else 0.0,
+             "recall": float(is_added.sum() / np.isin(tree["AP_labels"], list(added)).sum())}]
+
+
+def bench_cluster(tree, workdir):
+    Distancefilter = importlib.import_module("Distancefilter&cluster")
+    new, _ = new_points(tree)
+    n_added = sum(s["status"] == "added" for s in tree["shoots"])
+    records = []
+    for backend in ("sklearn", "grid"):
+        labels, seconds = timed(Distancefilter.cluster_points, new[:, :3], eps=2 * RMSE, min_samples=40, backend=backend)
+        n_clusters = len(set(labels.tolist()) - {-1})
+        records.append({"stage": f"cluster_points ({backend})", "seconds": seconds, "points": len(new),
+                        "shoots_true": n_added, "shoots_found": n_clusters})
+    return records
+
+
+def bench_measure(tree, workdir):
+    measurement = importlib.import_module("parameters_measurement")
+    from utils import LabeledCloud
+    point = LabeledCloud(tree["BP"], tree["BP_labels"])
+    point = point.select(point.labels >= 0)
+    truth = {s["label"]: s for s in tree["shoots"]}
+    records = []
+    for length_method in ("obb", "geodesic"):
+        shoots, seconds = timed(measurement.measure_shoots, point, length_method=length_method)
+        true_angle = np.array([truth[label]["angle"] for label in shoots["label"]])
+        true_length = np.array([truth[label]["length"] for label in shoots["label"]])
+        records.append({"stage": f"measure_shoots ({length_method})", "seconds": seconds, "points": len(point),
+                        "shoots": len(shoots),
+                        "angle_mae_deg": float(np.abs(shoots["angle"].to_numpy() - true_angle).mean()),
+                        "length_mae_m": float(np.abs(shoots["length"].to_numpy() - true_length).mean())})
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, nargs="+", default=[100_000, 1_000_000], help="points per scan")
+    parser.add_argument("--shoots", type=int, default=60, help="shoots of the BP scan")
+    parser.add_argument("--added", type=int, default=20, help="new shoots of the AP scan")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--out", help="append the results to this JSON lines file")
+    args = parser.parse_args()
+
+    benches = {"trunk": bench_trunk, "registration": bench_registration, "filter": bench_filter,
+               "cluster": bench_cluster, "measure": bench_measure}
+    for n_points in args.points:
+        tree, seconds = timed(make_tree, n_points, args.shoots, added=args.added, seed=args.seed)
+        print(f"== {n_points} points per scan (generated in {seconds:.1f} s)")
+        with tempfile.TemporaryDirectory() as workdir:
+            for name in args.stages:
+                try:
+                    records = benches[name](tree, workdir)
+                except ImportError as e:
+                    # Stages whose dependencies are missing are skipped, not fatal
+                    print(f"  {name}: skipped ({e})")
+                    continue
+                for record in records:
+                    record.update(n_points=n_points, seed=args.seed,
+                                  points_per_s=record["points"] / record["seconds"] if record["seconds"] else None)
+                    metrics = ", ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in record.items()
+                                        if k not in ("stage", "seconds", "points", "n_points", "seed", "points_per_s"))
+                    print(f"  {record['stage']:<32} {record['seconds']:8.2f} s  {record['points_per_s']:12.0f} pts/s  {metrics}")
+                    if args.out:
+                        with open(args.out, "a") as f:
+                            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
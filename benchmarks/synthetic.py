@@ -0,0 +1,115 @@
+import numpy as np
+
+
+# Radii of the tube parts of a synthetic tree (m)
+TRUNK_RADIUS = 0.07
+SCAFFOLD_RADIUS = 0.03
+SHOOT_RADIUS = 0.006
+NOISE = 0.001
+
+
+def _frames(tangents):
+    # Two unit normals perpendicular to every tangent
+    helper = np.where(np.abs(tangents[:, [2]]) < 0.9, [[0, 0, 1]], [[1, 0, 0]])
+    n1 = np.cross(tangents, helper)
+    n1 /= np.linalg.norm(n1, axis=1, keepdims=True)
+    return n1, np.cross(tangents, n1)
+
+
+def _centreline(base, direction, length, bend, samples=64):
+    # Shoot axis bending downwards (sag) by bend * length at its tip
+    s = np.linspace(0, 1, samples)[:, None]
+    return base + s * length * direction - bend * length * s ** 2 * np.array([0, 0, 1.0])
+
+
+def _sample_tube(line, radius, n, rng):
+    # Points on the surface of a tube around a polyline, uniform in arc length
+    seg = np.diff(line, axis=0)
+    seg_len = np.linalg.norm(seg, axis=1)
+    cum = np.concatenate(([0], np.cumsum(seg_len)))
+    s = rng.random(n) * cum[-1]
+    i = np.clip(np.searchsorted(cum, s, side="right") - 1, 0, len(seg) - 1)
+    tangents = seg[i] / seg_len[i, None]
+    centre = line[i] + tangents * (s - cum[i])[:, None]
+    n1, n2 = _frames(tangents)
+    theta = rng.random(n) * 2 * np.pi
+    points = centre + radius * (np.cos(theta)[:, None] * n1 + np.sin(theta)[:, None] * n2)
+    return points + rng.normal(0, NOISE, points.shape)
+
+
+def _direction(azimuth, elevation):
+    return np.array([np.cos(azimuth) * np.cos(elevation), np.sin(azimuth) * np.cos(elevation), np.sin(elevation)])
+
+
+def _elevation(line):
+    # Elevation of the main axis of a centreline, the angle cal_angle measures
+    centered = line - line.mean(axis=0)
+    axis = np.linalg.eigh(centered.T @ centered)[1][:, -1]
+    return np.degrees(np.arctan2(abs(axis[2]), np.hypot(axis[0], axis[1])))
+
+
+def random_rigid(rng, max_angle=10.0, max_tilt=1.0, max_shift=0.5):
+    """Random 4x4 rigid transform: rotation about z (degrees), a small tilt and a shift"""
+    from scipy.spatial.transform import Rotation
+    angles = np.radians([rng.uniform(-max_tilt, max_tilt), rng.uniform(-max_tilt, max_tilt),
+                         rng.uniform(-max_angle, max_angle)])
+    H = np.eye(4)
+    H[:3, :3] = Rotation.from_euler("xyz", angles).as_matrix()
+    H[:3, 3] = [rng.uniform(-max_shift, max_shift), rng.uniform(-max_shift, max_shift), rng.uniform(-0.05, 0.05)]
+    return H
+
+
+def make_tree(n_points=100_000, n_shoots=60, pruned=0.5, added=20, trunk_height=0.7, seed=0):
+    """Procedural trunk + scaffold + shoot tree scanned before (BP) and after (AP) pruning.
+
+    The BP scan holds the trunk, the scaffold branches and n_shoots shoots, of
+    which a fraction `pruned` is missing from the AP scan; the AP scan has
+    `added` new shoots instead and is moved by a random rigid transform H.
+    Points are spread over the tube surfaces by area, so every scan has about
+    n_points points.
+
+    Returns:
+        dict: BP/AP (n, 3) points, BP_labels/AP_labels (-1 trunk and scaffold,
+        else the shoot id), H (4x4, BP -> AP), trunk_height, and shoots: one
+        dict per shoot with label, status ("kept", "pruned" or "added"),
+        length (m) and angle (degrees, elevation of the shoot axis).
+    """
+    rng = np.random.default_rng(seed)
+    parts = [(np.array([[0, 0, 0], [0, 0, trunk_height]]), TRUNK_RADIUS, -1, "base")]
+
+    scaffolds = []
+    for azimuth in np.linspace(0, 2 * np.pi, 4, endpoint=False) + rng.uniform(0, np.pi / 2):
+        line = _centreline(np.array([0, 0, trunk_height]), _direction(azimuth, np.radians(rng.uniform(30, 50))),
+                           1.2, 0.05)
+        scaffolds.append(line)
+        parts.append((line, SCAFFOLD_RADIUS, -1, "base"))
+
+    shoots = []
+    n_kept = n_shoots - int(round(pruned * n_shoots))
+    statuses = ["kept"] * n_kept + ["pruned"] * (n_shoots - n_kept) + ["added"] * added
+    for label, status in enumerate(statuses):
+        scaffold = scaffolds[rng.integers(len(scaffolds))]
+        base = scaffold[rng.integers(10, len(scaffold))]
+        direction = _direction(rng.uniform(0, 2 * np.pi), np.radians(rng.uniform(10, 80)))
+        line = _centreline(base, direction, rng.uniform(0.2, 0.8), rng.uniform(0, 0.15))
+        parts.append((line, SHOOT_RADIUS, label, status))
+        shoots.append({"label": label, "status": status,
+                       "length": float(np.linalg.norm(np.diff(line, axis=0), axis=1).sum()),
+                       "angle": float(_elevation(line))})
+
+    def scan(statuses):
+        chosen = [p for p in parts if p[3] in statuses]
+        area = np.array([np.linalg.norm(np.diff(line, axis=0), axis=1).sum() * radius for line, radius, _, _ in chosen])
+        counts = rng.multinomial(n_points, area / area.sum())
+        points = np.vstack([_sample_tube(line, radius, n, rng) for (line, radius, _, _), n in zip(chosen, counts)])
+        labels = np.repeat([label for _, _, label, _ in chosen], counts)
+        order = rng.permutation(len(points))
+        return points[order], labels[order]
+
+    BP, BP_labels = scan(("base", "kept", "pruned"))
+    AP, AP_labels = scan(("base", "kept", "added"))
+    H = random_rigid(rng)
+    AP = AP @ H[:3, :3].T + H[:3, 3]
+
+    return {"BP": BP, "BP_labels": BP_labels, "AP": AP, "AP_labels": AP_labels, "H": H,
+            "trunk_height": trunk_height, "shoots": shoots}
@@ -1,26 +1,43 @@
 import os
+from functools import partial
 import numpy as np
-from scipy.spatial import cKDTree
 import open3d as o3d
 from sklearn.cluster import DBSCAN
 import hdbscan
-
-
+from utils import read_point_cloud, save_point_cloud, is_point_cloud, LabeledCloud, warm
+from batch import run_batch, write_later
+from stage_cache import run_stage, cached_arrays
+from profiling import profiled, stage
+from spatial import voxel_downsample_chunks, iter_blocks, min_bound, grid_dbscan
+from spatial import SpatialIndex, as_index, difference_masks, coordinates
+from downsampling import voxel_grid
+
+# Downsample scans in blocks of this many points, so that memory depends on the
+# block and not on the scan (None: whole-array Open3D path)
+CHUNK_SIZE = 2_000_000
+
+# Extension of the outputs: ".txt" (%.8f text), ".ply", ".npy" or ".npz" (binary)
+OUT_EXT = ".txt"
+
+# Preprocessing of the scans before the difference filter: voxel size, SOR (nb, std)
+VOXEL_SIZE = 0.001
+# Resolution of the clustering input
+CLUSTER_VOXEL = 0.001
+SOR = (20, 2.0)
+
+# Slab width (m) of the tiled difference filter and its worker processes, for
+# multi-tree or very dense scans (None: one KD-tree over the whole AP scan)
+DIFF_TILE = None
+DIFF_WORKERS = 1
+
+
+@profiled("distancefilter.load")
 def load_point_cloud(path, name):
     print("Loading point cloud: ", name)
     file_path = os.path.join(path, name)
 
-    if name.endswith('.txt'):
-        # Load txt file using numpy
-        point_cloud = np.loadtxt(file_path)[:, :3]
-        labels = np.loadtxt(file_path)[:, -1]
-    elif file_path.endswith('.ply'):
-        # Load ply file using open3d and convert to numpy array
-        point_cloud = o3d.io.read_point_cloud(file_path)
-        point_cloud = np.asarray(point_cloud.points)[:, :3]
-        labels = np.asarray(point_cloud)[:, -1]
-    else:
-        raise ValueError("Unsupported file format")
+    # txt/ply/pcd go through the binary cache, npy/npz are read natively
+    point_cloud, labels = read_point_cloud(file_path)
 
     return point_cloud, labels
 
@@ -32,34 +49,40 @@ def distance(point1, point2):
 
 # Calculate the average distance
 def calculate_average_distance(point_cloud):
-    # Create KDTree
-    tree = cKDTree(point_cloud)
-
-    # 计算每个点到其最近邻点的距离
-    distances, _ = tree.query(point_cloud, k=2)
-    distances = distances[:, 1]
-    # 计算平均距离
-    average_distance = distances.mean()
+    # 计算每个点到其最近邻点的平均距离 (reuses the cloud's index and cached k-NN)
+    average_distance = as_index(point_cloud).mean_spacing()
     print("Threshold: ", average_distance)
     return average_distance
 
 
 def filter_points_with_kdtree(A, B, threshold):
-    # 构建B点云的KD树
-    kdtree = cKDTree(A)
-    print("removing the points......")
+    return filter_points_multi(A, B, [threshold])[threshold]
+
 
-    # 批量查询KD树，而不是单点查询
-    distances, _ = kdtree.query(B, k=4, distance_upper_bound=threshold)
+def filter_points_multi(A, B, thresholds):
+    # A点云的KD树 (built once per cloud and shared with SOR), one query for all thresholds
+    # A labelled cloud keeps its labels through the filter
+    select = B.select if isinstance(B, LabeledCloud) else None
+    B = coordinates(B)
+    print("removing the points......")
 
-    # 使用向量化操作选出满足条件的点
-    mask = np.all(distances > threshold, axis=1)
-    return B[mask]
+    # Points whose 4 nearest points of A are all beyond the threshold
+    with stage("distancefilter.difference", len(B)) as record:
+        masks = difference_masks(A, B, thresholds, op=">", tile_size=DIFF_TILE, workers=DIFF_WORKERS)
+        record["points_out"] = int(sum(mask.sum() for mask in masks.values()))
+    return {threshold: select(mask) if select else B[mask] for threshold, mask in masks.items()}
 
 
 
+@profiled("distancefilter.sor")
 def remove_noise_sor(point_cloud, nb=20, std=2.0):
     print("Removing noise using SOR filter......")
+    if isinstance(point_cloud, LabeledCloud):
+        # Labelled clouds keep their labels through the filter
+        return point_cloud.select(SpatialIndex(point_cloud.xyz).sor_mask(nb, std))
+    if isinstance(point_cloud, SpatialIndex):
+        # Same statistic as open3d from the cached k-NN, the result keeps the KD-tree
+        return point_cloud.select(point_cloud.sor_mask(nb, std))
 
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(point_cloud)
@@ -67,19 +90,33 @@ def remove_noise_sor(point_cloud, nb=20, std=2.0):
     return pcd.select_by_index(ind)
 
 
-def voxel_downsample(point_cloud, voxel_size):
+@profiled("distancefilter.downsample")
+def voxel_downsample(point_cloud, voxel_size, chunk_size=None, labels=None):
     print("Downsampling the point cloud......")
+    if isinstance(point_cloud, LabeledCloud):
+        point_cloud, labels = point_cloud.xyz, point_cloud.labels
+    if labels is not None:
+        # Per-label voxel centroids, the labels stay with the points
+        return LabeledCloud(*voxel_grid(point_cloud, voxel_size, labels))
+    if chunk_size:
+        # Same grid as open3d (origin at min bound - voxel / 2), accumulated block by block
+        origin = min_bound(point_cloud, chunk_size) - voxel_size / 2
+        return voxel_downsample_chunks(iter_blocks(point_cloud, chunk_size), voxel_size, origin)
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(point_cloud)
     downsampled_pcd = pcd.voxel_down_sample(voxel_size=voxel_size)
     return np.asarray(downsampled_pcd.points)
 
 
-def cluster_points(point_cloud, eps, min_samples):
+@profiled("distancefilter.cluster")
+def cluster_points(point_cloud, eps, min_samples, backend="sklearn"):
     print("Clustering the points......")
+    if backend == "grid":
+        # Cell-based DBSCAN, same labels without storing every neighbourhood
+        return grid_dbscan(point_cloud, eps, min_samples)
     # Apply DBSCAN clustering algorithm
     dbscan = DBSCAN(eps=eps, min_samples=min_samples)
-    labels = dbscan.fit_predict(point_cloud)
+    labels = dbscan.fit_predict(coordinates(point_cloud))
     return labels
 
 
@@ -90,7 +127,24 @@ def hscan(point_cloud, min_samples):
     return labels.labels_
 
 
-def get_branches(BP_path, AP_path, output_path):
+def denoise_one(path, filename, cache=True):
+    """Downsampled, SOR filtered scan, reused while the file and parameters are unchanged"""
+    fresh = {}
+
+    def compute():
+        points, _ = load_point_cloud(path, filename)
+        points = SpatialIndex(voxel_downsample(points, VOXEL_SIZE, CHUNK_SIZE))
+        fresh["index"] = remove_noise_sor(points, *SOR)
+        return fresh["index"].points,
+
+    points = cached_arrays(cache, "denoise", [os.path.join(path, filename)],
+                           {"voxel_size": VOXEL_SIZE, "sor": SOR}, compute)[0]
+    # A fresh run keeps the KD-tree of the SOR for the difference filter
+    return fresh.get("index", points)
+
+
+def paired_files(BP_path, AP_path, check):
+    filenames = []
     for filename in os.listdir(AP_path):
         file_path = os.path.join(BP_path, filename)
         if not os.path.isfile(file_path):
@@ -98,95 +152,119 @@ def get_branches(BP_path, AP_path, output_path):
             print(f"File does not exist: {filename}. Skipping.")
             continue
 
-        if filename.startswith("e"):  # Checks if the file is a .txt file
-           
-            A, Alabel = load_point_cloud(AP_path, filename)
-            B, Blabel = load_point_cloud(BP_path, filename)
+        if check(filename):
+            filenames.append(filename)
+    return filenames
+
 
-            # downsample the point cloud
-            A, B = voxel_downsample(A, 0.001), voxel_downsample(B, 0.001)
+def get_branches_one(BP_path, AP_path, output_path, filename, xs=('10',), cache=True):
+    # One output per multiplier x of the rmse, all from one query
+    rmse = 0.009
+    output_files = [os.path.join(output_path,  x + os.path.splitext(filename)[0] + OUT_EXT) for x in xs]
+    params = {"xs": list(xs), "rmse": rmse, "voxel_size": VOXEL_SIZE, "sor": SOR, "out_ext": OUT_EXT}
 
-            # # Remove noise using SOR filter
-            A, B = np.asarray(remove_noise_sor(A).points), np.asarray(remove_noise_sor(B).points)
-            x = '10'
-            rmse = 0.009
-            threshold = int(x) * rmse
-            one_year_branches = filter_points_with_kdtree(A, B, threshold)
+    def compute():
+        # downsample the point cloud and remove noise using SOR filter (each scan cached on its own)
+        A, B = denoise_one(AP_path, filename, cache), denoise_one(BP_path, filename, cache)
+        thresholds = [int(x) * rmse for x in xs]
+        branches = filter_points_multi(A, B, thresholds)
+
+        for threshold, output_file in zip(thresholds, output_files):
+            one_year_branches = branches[threshold]
 
             # Cluster the points using DBSCAN
             # labels = cluster_points(one_year_branches, eps=0.03, min_samples=35)
             # Add the labels to the point cloud
             # one_year_branches = np.column_stack((one_year_branches, labels))
 
-            # Save the results
-            output_file = os.path.join(output_path,  x + filename)
-            np.savetxt(output_file, one_year_branches, fmt='%.8f')
+            # Save the results (in the background in a sequential batch)
+            write_later(save_point_cloud, output_file, one_year_branches)
 
+    run_stage(cache, "branches", [os.path.join(AP_path, filename), os.path.join(BP_path, filename)],
+              params, output_files, compute)
 
-def cluster_branch(input_path, output_path):
-    for filename in os.listdir(input_path):
-        if filename.startswith("10"):  # Checks if the file is a .txt file
-            one_year_branches, label = load_point_cloud(input_path, filename)
 
-            one_year_branches = voxel_downsample(one_year_branches, 0.001)
-            ave = calculate_average_distance(one_year_branches)
-            threshold = 12 * ave
+def get_branches(BP_path, AP_path, output_path, workers=1, threads=1, xs=('10',), cache=True):
+    filenames = paired_files(BP_path, AP_path, lambda f: f.startswith("e"))
+    job = partial(get_branches_one, BP_path, AP_path, output_path, xs=xs, cache=cache)
+    return run_batch(job, filenames, workers, threads, manifest=os.path.join(output_path, "branches_manifest.json"),
+                     prefetch=lambda f: warm(os.path.join(AP_path, f), os.path.join(BP_path, f)))
 
-            # Cluster the points using DBSCAN
-            labels = cluster_points(one_year_branches, eps=threshold, min_samples=40)
 
-            # Or HDBSCAN
-            # labels = hscan(one_year_branches, 10)
+def cluster_branch_one(input_path, output_path, filename, backend="sklearn", cache=True):
+    output_file = os.path.join(output_path, os.path.splitext(filename)[0] + "clustered" + OUT_EXT)
+    params = {"voxel_size": CLUSTER_VOXEL, "spacing": 12, "min_samples": 40, "backend": backend}
+    run_stage(cache, "cluster", [os.path.join(input_path, filename)], dict(params, out_ext=OUT_EXT), [output_file],
+              partial(_cluster_branch_one, input_path, output_file, filename, **params))
 
-            # Add the labels to the point cloud
-            one_year_branches = np.column_stack((one_year_branches, labels))
-            one_year_branches = one_year_branches[one_year_branches[:, -1] != -1]
 
-            # Save the results
-            output_file = os.path.join(output_path, filename[:-4] + "clustered.txt")
-            np.savetxt(output_file, one_year_branches, fmt='%.8f')
+def _cluster_branch_one(input_path, output_file, filename, voxel_size, spacing, min_samples, backend):
+    one_year_branches, label = load_point_cloud(input_path, filename)
 
+    # One index for the spacing and the clustering
+    one_year_branches = SpatialIndex(voxel_downsample(one_year_branches, voxel_size, CHUNK_SIZE))
+    ave = calculate_average_distance(one_year_branches)
+    threshold = spacing * ave
 
-def get_branche(BP_path, AP_path, output_path):
-    for filename in os.listdir(AP_path):
-        file_path = os.path.join(BP_path, filename)
-        if not os.path.isfile(file_path):
-            # If the file does not exist, skip it
-            print(f"File does not exist: {filename}. Skipping.")
-            continue
+    # Cluster the points using DBSCAN
+    labels = cluster_points(one_year_branches, eps=threshold, min_samples=min_samples, backend=backend)
 
-        if filename.endswith("txt"):  # Checks if the file is a .txt file
+    # Or HDBSCAN
+    # labels = hscan(one_year_branches, 10)
 
-            A, Alabel = load_point_cloud(AP_path, filename)
-            B, Blabel = load_point_cloud(BP_path, filename)
+    # Keep the clustered points with their labels
+    one_year_branches = LabeledCloud(one_year_branches.points, labels).select(labels != -1)
 
-            # downsample the point cloud
-            A, B = voxel_downsample(A, 0.001), voxel_downsample(B, 0.001)
+    # Save the results (in the background in a sequential batch)
+    write_later(save_point_cloud, output_file, one_year_branches)
 
-            # # Remove noise using SOR filter
-            A, B = np.asarray(remove_noise_sor(A).points), np.asarray(remove_noise_sor(B).points)
-            x = '2'
-            rmse = 0.009
-            threshold = int(x) * rmse
-            one_year_branches = filter_points_with_kdtree(A, B, threshold)
 
-            # Cluster the points using DBSCAN
-            labels = cluster_points(one_year_branches, eps=threshold, min_samples=40)
+def cluster_branch(input_path, output_path, workers=1, threads=1, backend="sklearn", cache=True):
+    filenames = [f for f in os.listdir(input_path) if f.startswith("10") and is_point_cloud(f)]
+    job = partial(cluster_branch_one, input_path, output_path, backend=backend, cache=cache)
+    return run_batch(job, filenames, workers, threads, manifest=os.path.join(output_path, "cluster_manifest.json"),
+                     prefetch=lambda f: warm(os.path.join(input_path, f)))
 
-            # Add the labels to the point cloud
-            one_year_branches = np.column_stack((one_year_branches, labels))
-
-            # Save the results
-            output_file = os.path.join(output_path, x + filename)
-            np.savetxt(output_file, one_year_branches, fmt='%.8f')
-
-# Get the branche
-BP_path = "/Users/dylan/PCD/Temporal/2024AP"  # Path to the folder with BP files
-AP_path = "/Users/dylan/PCD/Temporal/2025"  # Path to the folder with growth files
-output_path = "/Users/dylan/PCD/Temporal/" # Path for saving output
-get_branche(BP_path, AP_path, output_path)
-
-# # Cluster the branches
-# input_path = '/Users/dylan/PCD/Seg/branch/'
-# output_path = '/Users/dylan/PCD/Seg/branch/'
-# cluster_branch(input_path, output_path)
+
+def get_branche_one(BP_path, AP_path, output_path, filename, backend="sklearn", cache=True):
+    x = '2'
+    rmse = 0.009
+    min_samples = 40
+    output_file = os.path.join(output_path, x + os.path.splitext(filename)[0] + OUT_EXT)
+    params = {"x": x, "rmse": rmse, "min_samples": min_samples, "backend": backend,
+              "voxel_size": VOXEL_SIZE, "sor": SOR, "out_ext": OUT_EXT}
+
+    def compute():
+        # downsample the point cloud and remove noise using SOR filter (each scan cached on its own)
+        A, B = denoise_one(AP_path, filename, cache), denoise_one(BP_path, filename, cache)
+        threshold = int(x) * rmse
+        one_year_branches = filter_points_with_kdtree(A, B, threshold)
+
+        # Cluster the points using DBSCAN
+        labels = cluster_points(one_year_branches, eps=threshold, min_samples=min_samples, backend=backend)
+
+        # Save the results with their labels (in the background in a sequential batch)
+        write_later(save_point_cloud, output_file, one_year_branches, labels)
+
+    run_stage(cache, "branche", [os.path.join(AP_path, filename), os.path.join(BP_path, filename)],
+              params, [output_file], compute)
+
+
+def get_branche(BP_path, AP_path, output_path, workers=1, threads=1, backend="sklearn", cache=True):
+    filenames = paired_files(BP_path, AP_path, is_point_cloud)
+    job = partial(get_branche_one, BP_path, AP_path, output_path, backend=backend, cache=cache)
+    return run_batch(job, filenames, workers, threads, manifest=os.path.join(output_path, "branche_manifest.json"),
+                     prefetch=lambda f: warm(os.path.join(AP_path, f), os.path.join(BP_path, f)))
+
+
+if __name__ == "__main__":
+    # Get the branche
+    BP_path = "/Users/dylan/PCD/Temporal/2024AP"  # Path to the folder with BP files
+    AP_path = "/Users/dylan/PCD/Temporal/2025"  # Path to the folder with growth files
+    output_path = "/Users/dylan/PCD/Temporal/" # Path for saving output
+    get_branche(BP_path, AP_path, output_path)
+
+    # # Cluster the branches
+    # input_path = '/Users/dylan/PCD/Seg/branch/'
+    # output_path = '/Users/dylan/PCD/Seg/branch/'
+    # cluster_branch(input_path, output_path)
@@ -1,22 +1,41 @@
 import os
+from functools import partial
 import open3d as o3d
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.transform import Rotation
 from simpleicp import PointCloud, SimpleICP
+from utils import read_point_cloud, save_point_cloud, is_point_cloud, warm
+from spatial import voxel_downsample_chunks, voxel_keys, iter_blocks, min_bound, query_workers
+from batch import run_batch, write_later
+from stage_cache import run_stage
+from profiling import profiled, stage
+import visualize
 
+# Extension of the aligned outputs: ".txt" (%.8f text), ".ply", ".npy" or ".npz" (binary)
+OUT_EXT = ".txt"
 
+# SOR (nb_neighbors, std_ratio) of the trees and of the trunks, trunk slice (maxi, mini)
+TREE_SOR = (10, 5)
+TRUNK_SOR = (20, 3)
+TRUNK_SLICE = (0.2, 0.03)
+
+# Resolution registration needs: tree SOR, trunk extraction and ICP run on voxel
+# centroids of this size, the final transform still moves every point (None: full resolution)
+REGISTRATION_VOXEL = 0.005
+
+# Voxel passes run in blocks of this many points, so that memory depends on the
+# block and not on the scan
+CHUNK_SIZE = 2_000_000
+
+
+@profiled("register.load")
 def load_point_cloud(path, name):
     print("Loading point cloud: ", name)
     file_path = os.path.join(path, name)
 
-    if name.lower().endswith('.txt'):
-        # Load txt file using numpy
-        point_cloud = np.loadtxt(file_path)[:, :3]
-    elif file_path.lower().endswith(('.ply', '.pcd')):
-        # Load ply file using open3d and convert to numpy array
-        point_cloud = o3d.io.read_point_cloud(file_path)
-        point_cloud = np.asarray(point_cloud.points)[:, :3]
-    else:
-        raise ValueError("Unsupported file format")
+    # txt/ply/pcd go through the binary cache, npy/npz are read natively
+    point_cloud, _ = read_point_cloud(file_path)
 
     return point_cloud
 
@@ -43,26 +62,35 @@ def array2o3d(array):
     return pcd
 
 
+@profiled("register.downsample")
 def downsample(point_cloud, voxel_size):
-    try:
-        pcd = array2o3d(point_cloud)
-    except ValueError as e:
-        print(f"Invalid input: {e}")
-        return point_cloud  # 返回原始数据或抛出异常
-
-    downsampled = pcd.uniform_down_sample(every_k_points=int(1/voxel_size))
+    # Voxel-grid centroids (uniform_down_sample only kept every k-th point by index),
+    # accumulated block by block on Open3D's grid
+    if not voxel_size or point_cloud.size == 0:
+        return point_cloud
 
-    # 检查下采样后是否为空
-    if len(downsampled.points) == 0:
-        print(f"Warning: Downsampled point cloud is empty. Using original points.")
-        return point_cloud  # 返回原始数据或调整 voxel_size
+    origin = min_bound(point_cloud, CHUNK_SIZE) - voxel_size / 2
+    downsampled = voxel_downsample_chunks(iter_blocks(point_cloud, CHUNK_SIZE), voxel_size, origin)
 
-    print(f"Downsampled to {len(downsampled.points)} points")
-    return np.asarray(downsampled.points)
+    print(f"Downsampled to {len(downsampled)} points")
+    return downsampled
 
 
-def sor(point_cloud, nb_neighbors, std_ratio):
+@profiled("register.sor")
+def sor(point_cloud, nb_neighbors, std_ratio, voxel_size=None):
     print("Removing noise using SOR filter......")
+    if voxel_size:
+        # SOR over the voxel centroids, every point follows the verdict of its
+        # voxel; both passes run block by block, no per-point index of the scan
+        origin = min_bound(point_cloud, CHUNK_SIZE) - voxel_size / 2
+        centroids, keys = voxel_downsample_chunks(iter_blocks(point_cloud, CHUNK_SIZE), voxel_size, origin,
+                                                  return_keys=True)
+        inlier = sor_mask(centroids, nb_neighbors, std_ratio)
+        kept = []
+        for block in iter_blocks(point_cloud, CHUNK_SIZE):
+            voxel = np.searchsorted(keys, voxel_keys(np.asarray(block[:, :3], dtype=np.float64), origin, voxel_size))
+            kept.append(block[inlier[voxel]])
+        return np.concatenate(kept)
     pcd = array2o3d(point_cloud)
     print(">> SOR filter")
     # Create the SOR filter
@@ -71,6 +99,15 @@ def sor(point_cloud, nb_neighbors, std_ratio):
     return np.asarray(pcd.select_by_index(ind).points)
 
 
+def sor_mask(point_cloud, nb_neighbors, std_ratio):
+    # Inlier mask of the SOR filter
+    cl, ind = array2o3d(point_cloud).remove_statistical_outlier(nb_neighbors=nb_neighbors, std_ratio=std_ratio)
+    mask = np.zeros(len(point_cloud), dtype=bool)
+    mask[np.asarray(ind, dtype=np.int64)] = True
+    return mask
+
+
+@profiled("register.trunk")
 def get_trunk(points, maxi, mini):
     if points.size == 0:
         raise ValueError("get_trunk: input point cloud is empty.")
@@ -85,34 +122,38 @@ def get_trunk(points, maxi, mini):
     step = slice_thickness * (1 - overlap_ratio)
     z_slices = np.arange(z_min, z_max + 1e-6, step)
 
-    non_empty_slices = []
-    for z in z_slices:
-        mask = (points[:, 2] >= z) & (points[:, 2] < z + slice_thickness)
-        slice_points = points[mask]
-        if slice_points.size > 0:
-            non_empty_slices.append(slice_points)
+    # Sort once by z, every slice [z, z + thickness) is then a contiguous range
+    order = np.argsort(points[:, 2], kind="stable")
+    xs, ys, zs = (np.asarray(points[order, i]) for i in range(3))
+    starts = np.searchsorted(zs, z_slices, side="left")
+    ends = np.searchsorted(zs, z_slices + slice_thickness, side="left")
+    non_empty = np.flatnonzero(ends > starts)
 
-    if len(non_empty_slices) == 0:
+    if len(non_empty) == 0:
         raise ValueError("get_trunk: all slices are empty.")
 
-    bottom_slice = non_empty_slices[0]
-    x_range = np.max(bottom_slice[:, 0]) - np.min(bottom_slice[:, 0])
-    y_range = np.max(bottom_slice[:, 1]) - np.min(bottom_slice[:, 1])
-    bottom_xyz = (np.max(bottom_slice[:, 0]),
-                  np.max(bottom_slice[:, 1]),
-                  np.min(bottom_slice[:, 2]))
+    def slice_ranges(i):
+        a, b = starts[i], ends[i]
+        return np.ptp(xs[a:b]), np.ptp(ys[a:b])
 
+    first = non_empty[0]
+    a, b = starts[first], ends[first]
+    # Keep the original point order of the bottom slice
+    bottom_slice = points[np.sort(order[a:b])]
+    x_range, y_range = slice_ranges(first)
+    bottom_xyz = (np.max(xs[a:b]), np.max(ys[a:b]), zs[a])
+
+    # Walk the slices upwards and stop at the first one of the branch zone
     max_z_keep = None
-    for s in non_empty_slices:
-        slice_x_range = np.max(s[:, 0]) - np.min(s[:, 0])
-        slice_y_range = np.max(s[:, 1]) - np.min(s[:, 1])
+    for i in non_empty:
+        slice_x_range, slice_y_range = slice_ranges(i)
 
         # 超过一定扩展幅度就认为进入枝条区，停止
         if ((slice_x_range - x_range < maxi and slice_x_range - x_range > mini) or
             (slice_y_range - y_range < maxi and slice_y_range - y_range > mini)):
             break
 
-        max_z_keep = np.max(s[:, 2])
+        max_z_keep = zs[ends[i] - 1]
 
     if max_z_keep is None:
         # 说明 trunk 很短，只保留底层
@@ -124,13 +165,40 @@ def get_trunk(points, maxi, mini):
     return np.array(bottom_xyz), filtered_points
 
 
+def as_array(pc):
+    # Accept both open3d point clouds and (n, 3) arrays
+    return np.asarray(pc.points) if hasattr(pc, "points") else np.asarray(pc, dtype=np.float64)
+
+
+def build_target_index(target):
+    """Build the KD-tree of the fixed cloud once, it is reused by every ICP iteration"""
+    return cKDTree(as_array(target))
+
+
+def match_points(target_tree, source, max_distance=None, workers=None):
+    """Find the nearest target point of every source point in one bulk query.
+
+    Args:
+        target_tree (cKDTree): Index of the target cloud (see build_target_index).
+        source (np.array): Source points of shape (n, 3).
+        max_distance (float): Reject pairs further apart than this distance.
+        workers (int): Number of threads for the query, -1 uses all cores,
+            None the threads of the batch worker (spatial.QUERY_WORKERS).
+
+    Returns:
+        tuple: (source indices, target indices, distances) of the kept pairs.
+    """
+    bound = np.inf if max_distance is None else max_distance
+    dist, idx = target_tree.query(source, k=1, distance_upper_bound=bound, workers=query_workers(workers))
+    # Rejected pairs come back with an infinite distance
+    keep = np.isfinite(dist)
+    return np.flatnonzero(keep), idx[keep], dist[keep]
+
+
 def find_nearest_neighbors(source_pc, target_pc):
-    target_tree = o3d.geometry.KDTreeFlann(target_pc)
-    nearest_neighbors = []
-    for point in source_pc.points:
-        _, idx, _ = target_tree.search_knn_vector_3d(point, 1)
-        nearest_neighbors.append(target_pc.points[idx[0]])
-    return np.asarray(nearest_neighbors)
+    target_tree = build_target_index(target_pc)
+    _, idx, _ = match_points(target_tree, as_array(source_pc))
+    return target_tree.data[idx]
 
 
 def compute_centroids(source_points, nearest_neighbors):
@@ -154,68 +222,253 @@ def compute_z_rotation(source_points, nearest_neighbors, source_centroid, target
     return R
 
 
-def transform_by_H(X: np.ndarray, H: np.ndarray) -> np.ndarray:
+def estimate_normals(points, k=20, target_tree=None, block_size=100_000):
+    """Estimate unit normals as the smallest PCA axis of the k nearest neighbours"""
+    target_tree = cKDTree(points) if target_tree is None else target_tree
+    data = target_tree.data
+    k = min(k, len(data))
+    normals = np.empty((len(data), 3))
+
+    for start in range(0, len(data), block_size):
+        _, idx = target_tree.query(data[start:start + block_size], k=k, workers=query_workers())
+        neighbours = data[idx]
+        neighbours -= neighbours.mean(axis=1, keepdims=True)
+        # Batched 3x3 covariances, eigh sorts eigenvalues in ascending order
+        cov = np.einsum("bki,bkj->bij", neighbours, neighbours)
+        normals[start:start + block_size] = np.linalg.eigh(cov)[1][:, :, 0]
+    return normals
+
+
+def point_to_point_step(source_points, target_points):
+    # Closed-form rigid motion (SVD) between matched points
+    source_centroid, target_centroid = compute_centroids(source_points, target_points)
+    R = compute_z_rotation(source_points, target_points, source_centroid, target_centroid)
+    step = np.eye(4)
+    step[:3, :3], step[:3, 3] = R, target_centroid - R @ source_centroid
+    return step
+
+
+def point_to_plane_step(source_points, target_points, target_normals):
+    # Linearised point-to-plane least squares for (rotation vector, translation)
+    J = np.hstack((np.cross(source_points, target_normals), target_normals))
+    r = np.einsum("ij,ij->i", source_points - target_points, target_normals)
+    x = np.linalg.solve(J.T @ J, -J.T @ r)
+    step = np.eye(4)
+    step[:3, :3], step[:3, 3] = Rotation.from_rotvec(x[:3]).as_matrix(), x[3:]
+    return step
+
+
+def _icp_iterations(target_tree, moved, normals, max_iterations, max_distance, min_change):
+    H = np.eye(4)
+    for _ in range(max_iterations):
+        src, tgt, _ = match_points(target_tree, moved, max_distance)
+        if len(src) < 6:
+            raise ValueError("icp: not enough correspondences.")
+
+        if normals is None:
+            step = point_to_point_step(moved[src], target_tree.data[tgt])
+        else:
+            step = point_to_plane_step(moved[src], target_tree.data[tgt], normals[tgt])
+        moved = moved @ step[:3, :3].T + step[:3, 3]
+        H = step @ H
+
+        # Early termination on the transform delta of this iteration
+        angle = np.arccos(np.clip((np.trace(step[:3, :3]) - 1) / 2, -1, 1))
+        if angle < min_change and np.linalg.norm(step[:3, 3]) < min_change:
+            break
+    return H, moved
+
+
+def icp_point_to_point(A, B, max_iterations=50, max_distance=None, min_change=1e-6, target_tree=None):
+    """Rigid point-to-point ICP moving B onto A.
+
+    Args:
+        A (np.array): Fixed point cloud of shape (n, 3).
+        B (np.array): Moving point cloud of shape (m, 3).
+        max_iterations (int): Maximum number of iterations.
+        max_distance (float): Correspondences further apart are rejected.
+        min_change (float): Stop once the rotation (rad) and translation of an
+            iteration are both below this value.
+        target_tree (cKDTree): Optional prebuilt index of A.
+
+    Returns:
+        tuple: (H, moved B, distance residuals of the final correspondences).
+    """
+    target_tree = build_target_index(A) if target_tree is None else target_tree
+    H, moved = _icp_iterations(target_tree, np.array(as_array(B), dtype=np.float64), None,
+                               max_iterations, max_distance, min_change)
+    _, _, residuals = match_points(target_tree, moved, max_distance)
+    return H, moved, residuals
+
+
+def pyramid_icp(A, B, voxel_sizes=(0.02, 0.01, None), method="point_to_plane", max_iterations=30,
+                min_change=1e-5, max_distance=3.0, n_neighbors=20, correspondences=20000):
+    """Coarse-to-fine ICP moving B onto A, a drop-in for SimpleICP.run.
+
+    Each level registers voxel-downsampled copies of both clouds, starting from
+    the transform of the previous level, so that the full-resolution level only
+    needs a few iterations.
+
+    Args:
+        A (np.array): Fixed point cloud of shape (n, 3).
+        B (np.array): Moving point cloud of shape (m, 3).
+        voxel_sizes (tuple): Voxel size of every level, None is full resolution.
+        method (str): "point_to_plane" (normals of A are precomputed per level)
+            or "point_to_point".
+        max_iterations (int): Maximum number of iterations per level.
+        min_change (float): Early termination threshold on the transform delta.
+        max_distance (float): Correspondences further apart than max_distance
+            times the voxel size of the level are rejected.
+        n_neighbors (int): Neighbours used for the normal estimation.
+        correspondences (int): Number of evenly spaced points of B matched per
+            iteration (SimpleICP uses 2000), None matches all of them.
+
+    Returns:
+        tuple: (H, moved B, rigid body parameters [alpha1, alpha2, alpha3, tx, ty, tz],
+        distance residuals), like SimpleICP.run.
+    """
+    A, B = as_array(A), as_array(B)
+    H = np.eye(4)
+    reject = None
+
+    for voxel in voxel_sizes:
+        if voxel:
+            A_level = voxel_downsample_chunks([A], voxel, np.min(A, axis=0) - voxel / 2)
+            B_level = voxel_downsample_chunks([B], voxel, np.min(B, axis=0) - voxel / 2)
+            reject = max_distance * voxel
+        else:
+            A_level, B_level = A, B
+
+        target_tree = build_target_index(A_level)
+        normals = estimate_normals(A_level, n_neighbors, target_tree) if method == "point_to_plane" else None
+        if correspondences and len(B_level) > correspondences:
+            B_level = B_level[np.linspace(0, len(B_level) - 1, correspondences).astype(int)]
+        moved = B_level @ H[:3, :3].T + H[:3, 3]
+        step, _ = _icp_iterations(target_tree, moved, normals, max_iterations, reject, min_change)
+        H = step @ H
+        print(f"ICP level {voxel or 'full'}: {len(A_level)} / {len(B_level)} points")
+
+    B_moved = B @ H[:3, :3].T + H[:3, 3]
+    _, _, residuals = match_points(target_tree, B_moved, reject)
+    params = np.concatenate((Rotation.from_matrix(H[:3, :3]).as_euler("xyz"), H[:3, 3]))
+    return H, B_moved, params, residuals
+
+
+def translation_H(t: np.ndarray) -> np.ndarray:
+    """Homogeneous matrix of a pure translation t."""
+    H = np.eye(4)
+    H[:3, 3] = t
+    return H
+
+
+def compose_H(*Hs: np.ndarray) -> np.ndarray:
+    """Compose homogeneous matrices, the first one is applied first.
+
+    compose_H(translation_H(t), H) maps X to H @ (X + t), so the prealign and
+    the ICP result touch the points only once.
+    """
+    H_total = np.eye(4)
+    for H in Hs:
+        H_total = H @ H_total
+    return H_total
+
+
+@profiled("register.transform")
+def transform_by_H(X: np.ndarray, H: np.ndarray, out: np.ndarray = None,
+                   dtype=np.float64, block_size: int = 1_000_000) -> np.ndarray:
     """Transform points by applying a homogeneous transformation matrix H.
 
+    The rotation and translation are applied block by block, so no (n, 4)
+    homogeneous copy of the cloud is ever made.
+
     Args:
         X (np.array): Point cloud data as a numpy array of shape (n, 3).
         H (np.array): Homogeneous transformation matrix H of shape (4, 4).
+        out (np.array): Optional (n, 3) output array, pass X itself to
+            transform in place.
+        dtype: dtype of the output when out is not given (e.g. np.float32).
+        block_size (int): Number of points transformed at a time.
 
     Returns:
         np.array: Transformed point cloud data.
     """
-    # 将欧拉坐标转换为齐次坐标
-    n = X.shape[0]
-    ones = np.ones((n, 1))
-    Xh = np.hstack((X, ones))
+    if out is None:
+        out = np.empty((X.shape[0], 3), dtype=dtype)
+    R, t = H[:3, :3], H[:3, 3]
+    # Only projective matrices need the division by w
+    projective = not np.array_equal(H[3], [0, 0, 0, 1])
 
-    # 应用齐次变换矩阵H
-    Xh = (H @ Xh.T).T  # transform in-place to save memory
+    for start in range(0, X.shape[0], block_size):
+        block = np.asarray(X[start:start + block_size, :3], dtype=np.float64)
+        moved = block @ R.T + t
+        if projective:
+            # 将变换后的齐次坐标转换回欧拉坐标
+            moved /= (block @ H[3, :3] + H[3, 3])[:, np.newaxis]
+        out[start:start + block_size] = moved
 
-    # 将变换后的齐次坐标转换回欧拉坐标
-    Xe = Xh[:, :3] / Xh[:, 3][:, np.newaxis]
+    return out
 
-    return Xe
 
+def show2pcd(A: np.ndarray, B: np.ndarray, name, png_prefix=None):
+    # A blue, B red: an open3d window, a background PNG snapshot or nothing (PCD_VIS, see visualize.mode)
+    visualize.show([A, B], [[0, 0, 1], [1, 0, 0]], name, png_prefix)
 
-def show2pcd(A: np.ndarray, B: np.ndarray, name):
 
-    A_pcd = array2o3d(A)
-    A_pcd.paint_uniform_color([0, 0, 1])
-    B_pcd = array2o3d(B)
-    B_pcd.paint_uniform_color([1, 0, 0])
+def align_one(AP, BP, out_path, filename, show=True, icp_method="simpleicp", cache=True):
+    # An unchanged pair of scans reuses the aligned tree of an earlier run
+    out_file = f"{out_path}moved_{os.path.splitext(filename)[0]}{OUT_EXT}"
+    params = {"icp_method": icp_method, "tree_sor": TREE_SOR, "trunk_sor": TRUNK_SOR, "trunk_slice": TRUNK_SLICE,
+              "voxel_size": REGISTRATION_VOXEL, "out_ext": OUT_EXT}
+    run_stage(cache, "align", [os.path.join(AP, filename), os.path.join(BP, filename)], params, [out_file],
+              partial(_align_one, AP, BP, out_file, filename, show, icp_method))
 
-    o3d.visualization.draw_geometries([A_pcd, B_pcd], window_name = name)
 
+def _align_one(AP, BP, out_file, filename, show, icp_method):
+    # get the tree and show
+    A_tree = load_point_cloud(AP, filename)
+    B_tree = load_point_cloud(BP, filename)
+    print(f"A_tree shape: {A_tree.shape}, B_tree shape: {B_tree.shape}")
+    # Off-screen snapshots go to qa/<tree>_<view>.png next to the outputs
+    qa = os.path.join(os.path.dirname(out_file), "qa", os.path.splitext(filename)[0])
+    # show2pcd(A_tree, B_tree, name = "Origin Trees")
+
+    H, A_tree, B_tree = register_trees(A_tree, B_tree, icp_method, show, qa)
+
+    # Apply the prealign and the ICP transformation to the whole tree in one pass
+    moved_B_tree = transform_by_H(B_tree, H, out=B_tree)
+
+    # Written in the background while the next tree loads (moved_B_tree is not changed after this)
+    write_later(save_point_cloud, out_file, moved_B_tree)
+    if show:
+        show2pcd(A_tree, moved_B_tree, name = "ICPed Trees", png_prefix=qa)
 
-def align_tree(AP, BP, out_path):
-    for filename in os.listdir(AP):
-        file_path = os.path.join(BP, filename)
-        if not os.path.isfile(file_path):
-            # If the file does not exist, skip it
-            print(f"File does not exist: {filename}. Skipping.")
-            continue
 
-        if filename.endswith("txt"):
-            # get the tree and show
-            A_tree = load_point_cloud(AP, filename)
-            B_tree = load_point_cloud(BP, filename)
-            print(f"A_tree shape: {A_tree.shape}, B_tree shape: {B_tree.shape}")
-            # show2pcd(A_tree, B_tree, name = "Origin Trees")
-
-            A_tree = sor(A_tree,10,5), 0.001
-            B_tree = sor(B_tree,10,5), 0.001
-            # Extract the trunk of the tree
-            
-            A_xyz, A_trunk = get_trunk(A_tree, 0.2, 0.03)
-            B_xyz, B_trunk = get_trunk(B_tree, 0.2, 0.03)
-            
-            # Apply the first alignment on trunk and show
-            t = A_xyz - B_xyz
-            B_trunk = sor(B_trunk + t,20,3)
-            A_trunk = sor(A_trunk,20,3)            
-            show2pcd(A_trunk, B_trunk, name = "1st aligned Trunks")
+def register_trees(A_tree, B_tree, icp_method="simpleicp", show=False, qa=None):
+    """Transform moving B_tree onto A_tree: trunk prealign, then ICP on the trunks.
 
+    Returns:
+        tuple: (H, A_tree, B_tree), H the 4x4 transform of B onto A and the
+        two trees after SOR (B not moved yet).
+    """
+    A_tree = sor(A_tree, *TREE_SOR, voxel_size=REGISTRATION_VOXEL)
+    B_tree = sor(B_tree, *TREE_SOR, voxel_size=REGISTRATION_VOXEL)
+    # Extract the trunk of the tree (at the registration resolution)
+
+    A_xyz, A_trunk = get_trunk(downsample(A_tree, REGISTRATION_VOXEL), *TRUNK_SLICE)
+    B_xyz, B_trunk = get_trunk(downsample(B_tree, REGISTRATION_VOXEL), *TRUNK_SLICE)
+
+    # Apply the first alignment on trunk and show
+    t = A_xyz - B_xyz
+    B_trunk = sor(B_trunk + t, *TRUNK_SOR)
+    A_trunk = sor(A_trunk, *TRUNK_SOR)
+    if show:
+        show2pcd(A_trunk, B_trunk, name = "1st aligned Trunks", png_prefix=qa)
+
+    with stage("register.icp", len(B_trunk)) as record:
+        if icp_method == "pyramid":
+            # Coarse-to-fine point-to-plane ICP, returns the same outputs as SimpleICP
+            H, B_moved, rigid_body_transformation_params, distance_residuals = pyramid_icp(A_trunk, B_trunk)
+        else:
             # Create point cloud objects
             A = PointCloud(A_trunk, columns=["x", "y", "z"])
             B = PointCloud(B_trunk, columns=["x", "y", "z"])
@@ -224,16 +477,35 @@ def align_tree(AP, BP, out_path):
             icp.add_point_clouds(A, B)
 
             H, B_moved, rigid_body_transformation_params, distance_residuals = icp.run(correspondences = 2000, min_change = 0.001, max_iterations = 100)
+        record["points_out"] = len(B_moved)
+
+    print(H.shape)
+
+    if show:
+        show2pcd(A_trunk, B_moved, name = "ICPed Trunks", png_prefix=qa)
 
-            print(H.shape)
+    return compose_H(translation_H(t), H), A_tree, B_tree
 
-            show2pcd(A_trunk, B_moved, name = "ICPed Trunks")
 
-            # Apply the transformation to the whole tree
-            moved_B_tree = transform_by_H((B_tree + t), H)
+def align_tree(AP, BP, out_path, workers=1, threads=1, icp_method="simpleicp", cache=True):
+    filenames = []
+    for filename in os.listdir(AP):
+        file_path = os.path.join(BP, filename)
+        if not os.path.isfile(file_path):
+            # If the file does not exist, skip it
+            print(f"File does not exist: {filename}. Skipping.")
+            continue
+
+        if is_point_cloud(filename):
+            filenames.append(filename)
 
-            np.savetxt(f"{out_path}moved_{filename}", moved_B_tree, fmt = "%.8f")
-            show2pcd(A_tree, moved_B_tree, name = "ICPed Trees")
+    # The windows block, only show them when aligning one tree at a time (snapshots never block)
+    show = workers == 1 or visualize.mode() != "window"
+    job = partial(align_one, AP, BP, out_path, show=show, icp_method=icp_method, cache=cache)
+    records = run_batch(job, filenames, workers, threads, manifest=f"{out_path}align_manifest.json",
+                        prefetch=lambda f: warm(os.path.join(AP, f), os.path.join(BP, f)))
+    visualize.flush()
+    return records
 
 
 if __name__ == "__main__":
@@ -243,7 +515,8 @@ if __name__ == "__main__":
     path_b = '/Users/dylan/PCD/Before prun/'
     out_path = '/Users/dylan/PCD/'
 
-    align_tree(path_a, path_b, out_path)
+    # More than one worker aligns trees in parallel (without the windows)
+    align_tree(path_a, path_b, out_path, workers=1)
     
 
     # Save the aligned point clouds
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from profiling import run_tree, summarize, enabled, PROFILE_ENV
+import spatial
+
+
+# Thread pools of numpy/scipy (BLAS) and open3d (OpenMP) read these at start-up
+THREAD_ENV = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+              "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+# Sequential batches read PREFETCH items ahead of the one being processed and
+# queue up to WRITE_QUEUE writes before the processing waits for the writer
+PREFETCH = 1
+WRITE_QUEUE = 2
+
+_writer = None
+
+
+def limit_threads(threads):
+    """Cap BLAS/OpenMP and KD-tree query threads of the current process"""
+    spatial.QUERY_WORKERS = threads
+    for name in THREAD_ENV:
+        os.environ[name] = str(threads)
+    try:
+        # Libraries that are already loaded only listen to threadpoolctl
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+@contextmanager
+def thread_limit(threads):
+    """Cap BLAS/OpenMP and KD-tree query threads of this process and of the
+    workers it starts inside the block, the previous limits are restored afterwards"""
+    saved = {name: os.environ.get(name) for name in THREAD_ENV}
+    saved_workers, spatial.QUERY_WORKERS = spatial.QUERY_WORKERS, threads
+    for name in THREAD_ENV:
+        os.environ[name] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        limiter = threadpool_limits(threads)
+    except ImportError:
+        limiter = None
+    try:
+        yield
+    finally:
+        spatial.QUERY_WORKERS = saved_workers
+        if limiter is not None:
+            limiter.restore_original_limits()
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _run_one(func, item):
+    # Failure isolation: a bad scan becomes a failed record, not a dead batch
+    start = time.time()
+    try:
+        result = run_tree(func, item)
+        return {"item": item, "ok": True, "seconds": time.time() - start, "result": result}
+    except Exception as e:
+        print(f"Failed on {item}: {e}")
+        return {"item": item, "ok": False, "seconds": time.time() - start,
+                "error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()}
+
+
+class BackgroundWriter:
+    """One thread running queued write jobs in order.
+
+    The bounded queue is the backpressure: a tree that produces outputs
+    faster than the disk takes them waits, so at most max_pending outputs
+    are held in memory. Failures are kept per item and reported by close;
+    once a job of an item fails, its later jobs (e.g. storing its outputs in
+    the stage cache) are skipped.
+    """
+
+    def __init__(self, max_pending=WRITE_QUEUE):
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self.item = None
+        self.errors = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            item, func, args, kwargs = job
+            try:
+                if item not in self.errors:
+                    func(*args, **kwargs)
+            except Exception as e:
+                self.errors.setdefault(item, {"error": f"{type(e).__name__}: {e}", "traceback": traceback.format_exc()})
+            finally:
+                self._jobs.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        self._jobs.put((self.item, func, args, kwargs))
+
+    def close(self):
+        """Wait for the queued writes and stop the thread, return the failures per item"""
+        self._jobs.put(None)
+        self._thread.join()
+        return self.errors
+
+
+def write_later(func, *args, **kwargs):
+    """Run a write job on the batch writer thread, or right away outside of a sequential batch.
+
+    The job runs after the caller has moved on, so it must own its arguments
+    (no array the caller changes afterwards). Jobs run in submission order.
+    """
+    if _writer is None:
+        func(*args, **kwargs)
+    else:
+        _writer.submit(func, *args, **kwargs)
+
+
+def _read_ahead(items, prefetch, depth):
+    # Items come out of the queue once prefetch(item) is done, at most depth ahead
+    ready = queue.Queue(maxsize=depth)
+
+    def read():
+        for item in items:
+            try:
+                prefetch(item)
+            except Exception as e:
+                # The tree itself runs into the error again and records it
+                print(f"Prefetch failed on {item}: {e}")
+            ready.put(item)
+
+    threading.Thread(target=read, daemon=True).start()
+    for _ in items:
+        yield ready.get()
+
+
+def write_manifest(path, records, workers, threads):
+    """Write a JSON summary of succeeded and failed items of a batch"""
+    manifest = {
+        "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "workers": workers,
+        "threads_per_worker": threads,
+        "succeeded": [{"item": r["item"], "seconds": r["seconds"]} for r in records if r["ok"]],
+        "failed": [{k: r[k] for k in ("item", "seconds", "error", "traceback")} for r in records if not r["ok"]],
+    }
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+
+
+def run_batch(func, items, workers=1, threads=1, manifest=None, prefetch=None):
+    """Run func(item) for every item, optionally over a process pool.
+
+    Args:
+        func: Picklable callable taking one item (e.g. a functools.partial of a
+            module-level per-tree function).
+        items (list): Work items, usually file names.
+        workers (int): Number of worker processes, 1 runs in this process.
+        threads (int): BLAS/OpenMP threads per worker, or of this process
+            while the batch runs with one worker.
+        manifest (str): Optional path of a JSON run manifest.
+        prefetch: Optional callable reading an item ahead (e.g. warming the
+            binary cache of its scans). With one worker it runs on a reader
+            thread PREFETCH items ahead, and write_later jobs of the items go
+            to a writer thread, so loading, processing and writing overlap.
+            A pool already overlaps them across its workers.
+
+    Returns:
+        list: One record per item, in the order of items, with keys item, ok,
+        seconds and result (or error/traceback).
+    """
+    items = list(items)
+    records = {}
+
+    if workers == 1:
+        global _writer
+        _writer = BackgroundWriter()
+        try:
+            with thread_limit(threads):
+                for item in (_read_ahead(items, prefetch, PREFETCH) if prefetch else items):
+                    _writer.item = item
+                    records[item] = _run_one(func, item)
+        finally:
+            writer, _writer = _writer, None
+            # A tree whose outputs failed to be written has failed
+            for item, error in writer.close().items():
+                records.setdefault(item, {"item": item, "seconds": 0.0}).update(ok=False, **error)
+                print(f"Failed writing {item}: {error['error']}")
+    else:
+        # Spawned workers inherit the environment, forked ones use threadpoolctl
+        with thread_limit(threads), \
+                ProcessPoolExecutor(max_workers=workers, initializer=limit_threads, initargs=(threads,)) as pool:
+            futures = {pool.submit(_run_one, func, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    records[item] = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died (e.g. segfault), the remaining items fail with it
+                    records[item] = {"item": item, "ok": False, "seconds": 0.0,
+                                     "error": f"BrokenProcessPool: {e}", "traceback": ""}
+                print(f"[{len(records)}/{len(items)}] {item}: {'done' if records[item]['ok'] else 'FAILED'}")
+
+    records = [records[item] for item in items]
+    if manifest:
+        write_manifest(manifest, records, workers, threads)
+    failed = sum(not r["ok"] for r in records)
+    print(f"Batch finished: {len(records) - failed} succeeded, {failed} failed.")
+    if enabled():
+        # Stage totals of the whole log (PCD_PROFILE), slowest first
+        summary = os.path.splitext(os.environ[PROFILE_ENV])[0] + ".csv"
+        for row in summarize(os.environ[PROFILE_ENV], summary)[:5]:
+            print(f"  {row['stage']}: {row['wall_s']:.1f} s wall, {row['peak_rss_mb']:.0f} MB peak")
+    return records
@@ -0,0 +1,148 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from spatial import voxel_keys, query_workers
+
+
+def voxel_index(points, voxel_size, labels=None, origin=None):
+    """Voxel id (0 .. n_voxels - 1) of every point.
+
+    The grid is Open3D's (origin at min bound - voxel_size / 2) unless origin
+    is given. With labels, points of different labels never share a voxel.
+
+    Returns:
+        tuple: (inverse, n_voxels).
+    """
+    xyz = np.asarray(points[:, :3], dtype=np.float64)
+    if origin is None:
+        origin = xyz.min(axis=0) - voxel_size / 2
+    inverse = np.unique(voxel_keys(xyz, origin, voxel_size), return_inverse=True)[1].ravel()
+    if labels is not None:
+        label_ids = np.unique(labels, return_inverse=True)[1].ravel()
+        inverse = np.unique(inverse * (label_ids.max() + 1) + label_ids, return_inverse=True)[1].ravel()
+    return inverse, int(inverse.max()) + 1 if len(inverse) else 0
+
+
+def voxel_grid(points, voxel_size, labels=None, mode="centroid", origin=None, return_inverse=False):
+    """Hashed voxel-grid downsampling.
+
+    Args:
+        points (np.ndarray): (n, >=3) points.
+        voxel_size (float): Edge of the voxels.
+        labels (np.ndarray): Optional (n,) labels, kept per voxel (a voxel
+            never mixes labels).
+        mode (str): "centroid" (mean of each voxel, like Open3D's
+            voxel_down_sample) or "first" (first point of each voxel, kept
+            unchanged with all its columns).
+        origin (np.ndarray): Grid origin, Open3D's by default.
+        return_inverse (bool): Also return the voxel of every input point.
+
+    Returns:
+        tuple: (points, labels), labels is None without input labels, plus
+        the inverse when asked for.
+    """
+    inverse, n = voxel_index(points, voxel_size, labels, origin)
+    first = np.unique(inverse, return_index=True)[1]
+    if mode == "first":
+        out = np.asarray(points[first])
+    elif mode == "centroid":
+        counts = np.bincount(inverse, minlength=n)
+        out = np.column_stack([np.bincount(inverse, weights=points[:, i], minlength=n) for i in range(3)]) / counts[:, None]
+    else:
+        raise ValueError(f"Unknown voxel mode: {mode}")
+
+    out_labels = np.asarray(labels)[first] if labels is not None else None
+    if return_inverse:
+        return out, out_labels, inverse
+    return out, out_labels
+
+
+def poisson_disk(points, radius, seed=0):
+    """Indices of a Poisson-disk subset of the points.
+
+    No two kept points are closer than radius and every dropped point lies
+    within radius of a kept one. Darts are thrown on a grid of cells of side
+    radius in 27 phases: cells of one phase are at least two cells apart, so
+    all of them take one candidate at once, after which every point within
+    radius of the new samples leaves the candidates.
+    """
+    xyz = np.asarray(points[:, :3], dtype=np.float64)
+    origin = xyz.min(axis=0)
+    cell = np.floor((xyz - origin) / radius).astype(np.int64)
+    cell_id = voxel_keys(xyz, origin, radius)
+    phase = (cell % 3) @ np.array([9, 3, 1])
+    priority = np.random.default_rng(seed).permutation(len(xyz))
+    tree = cKDTree(xyz)
+
+    kept = np.zeros(len(xyz), dtype=bool)
+    alive = np.ones(len(xyz), dtype=bool)
+    while alive.any():
+        for p in range(27):
+            candidates = np.flatnonzero(alive & (phase == p))
+            if not candidates.size:
+                continue
+            # The candidate of lowest priority of every cell
+            order = candidates[np.lexsort((priority[candidates], cell_id[candidates]))]
+            samples = order[np.unique(cell_id[order], return_index=True)[1]]
+            kept[samples] = True
+            covered = tree.query_ball_point(xyz[samples], radius, workers=query_workers())
+            alive[np.concatenate(covered).astype(np.int64)] = False
+    return np.flatnonzero(kept)
+
+
+def density_cap(points, voxel_size, max_points, labels=None, seed=0):
+    """Indices keeping at most max_points random points per voxel.
+
+    Adaptive density: dense parts of the scan (e.g. the trunk close to the
+    scanner) are thinned to max_points per voxel, sparse parts (thin shoots)
+    keep every point.
+    """
+    inverse, _ = voxel_index(points, voxel_size, labels)
+    priority = np.random.default_rng(seed).random(len(inverse))
+    order = np.lexsort((priority, inverse))
+    grouped = inverse[order]
+    starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    return np.sort(order[rank < max_points])
+
+
+def voxel_size_for(points, target_points, tol=0.05, max_iterations=30):
+    """Voxel size whose centroid grid has about target_points points (bisection)"""
+    xyz = np.asarray(points[:, :3], dtype=np.float64)
+    if target_points >= len(xyz):
+        return None
+    lo, hi = 1e-5, float(np.ptp(xyz, axis=0).max())
+    size = hi
+    for _ in range(max_iterations):
+        size = np.sqrt(lo * hi)
+        n = voxel_index(xyz, size)[1]
+        if abs(n - target_points) <= tol * target_points:
+            break
+        lo, hi = (size, hi) if n > target_points else (lo, size)
+    return size
+
+
+def downsample(points, method="voxel", size=0.001, labels=None, **options):
+    """Downsample a cloud with one of the methods of this module.
+
+    Args:
+        points (np.ndarray): (n, >=3) points.
+        method (str): "voxel" (voxel centroids), "voxel_first" (first point
+            per voxel), "poisson" (Poisson disk of radius size) or "adaptive"
+            (at most options["max_points"] points per voxel of side size).
+        size (float): Voxel size or disk radius.
+        labels (np.ndarray): Optional (n,) labels, carried to the output.
+
+    Returns:
+        tuple: (points, labels), labels is None without input labels.
+    """
+    if method == "voxel":
+        return voxel_grid(points, size, labels, "centroid", options.get("origin"))
+    if method == "voxel_first":
+        return voxel_grid(points, size, labels, "first", options.get("origin"))
+    if method == "poisson":
+        keep = poisson_disk(points, size, options.get("seed", 0))
+    elif method == "adaptive":
+        keep = density_cap(points, size, options.get("max_points", 8), labels, options.get("seed", 0))
+    else:
+        raise ValueError(f"Unknown downsampling method: {method}")
+    return np.asarray(points[keep]), (np.asarray(labels)[keep] if labels is not None else None)
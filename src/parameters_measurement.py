@@ -2,167 +2,454 @@ import numpy as np
 import open3d as o3d
 import os
 import pandas as pd
-import math
-import traceback
-from scipy.spatial import ConvexHull
+import time
+import hashlib
+import multiprocessing
+from multiprocessing.connection import wait
+from functools import partial
+from scipy.spatial import ConvexHull, cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree, connected_components, dijkstra
 from scipy.interpolate import splprep, splev
+from utils import read_labeled, is_point_cloud, as_cloud, warm, CACHE_DIR_NAME
+from batch import run_batch, limit_threads
+from profiling import profiled
+from downsampling import voxel_grid
+from spatial import query_workers
 
 
+SKELETON_DOWN_SAMPLE = 0.003
+SKELETON_MIN_POINTS = 30  # smaller shoots get a PCA skeleton
+SKELETON_TIMEOUT = 120  # seconds of contraction per shoot before falling back (workers > 1)
+LENGTH_VOXEL = 0.01  # graph nodes of the geodesic shoot length
+
+
+@profiled("measure.load")
 def load_point_cloud(path, name):
     print("Loading point cloud: ", name)
     file_path = path + name
 
-    if name.endswith('txt'):
-        # Load txt file using numpy
-        point_cloud = np.loadtxt(file_path)[:, :4]
-        labels = np.unique(np.loadtxt(file_path)[:, -1])
-    elif file_path.endswith('.ply' or '.pcd'):
-        # Load ply file using open3d and convert to numpy array
-        point_cloud = o3d.io.read_point_cloud(file_path)
-        point_cloud = np.asarray(point_cloud.points)[:, :4]
-        labels = np.unique(np.asarray(point_cloud)[:, -2])
-    else:
-        raise ValueError("Unsupported file format")
-
-    return point_cloud, labels
-
-# def skeletonize_point_cloud(points):
-#     from pc_skeletor import skeletor
-#
-#     pcd = o3d.geometry.PointCloud()
-#     pcd.points = o3d.utility.Vector3dVector(points[:, [0, 1, 2]])
-#
-#     num_points = len(points)
-#     if num_points < 30:
-#         return pcd, pcd
-#
-#     n_neighbors = min(30, num_points - 1)
-#     skeletor = skeletor.Skeletonizer(point_cloud=pcd, down_sample=0.003, debug=False)
-#     laplacian_config = {
-#         "MAX_LAPLACE_CONTRACTION_WEIGHT": 1024,
-#         "MAX_POSITIONAL_WEIGHT": 10240,
-#         "INIT_LAPLACIAN_SCALE": 100,
-#         "N_NEIGHBORS": n_neighbors
-#     }
-#
-#     try:
-#         skeleton, graph = skeletor.extract(method='Laplacian', config=laplacian_config)
-#     except RuntimeError as e:
-#         print(f"Encountered an error: {str(e)}")
-#         n_neighbors = min(10, num_points - 1)
-#         laplacian_config['N_NEIGHBORS'] = n_neighbors
-#
-#         try:
-#             skeleton, graph = skeletor.extract(method='Laplacian', config=laplacian_config)
-#         except RuntimeError as e:
-#             print("Failed again, skipping this point cloud.")
-#             print(f"Full error message: {traceback.format_exc()}")
-#             return pcd, pcd
-#
-#     return skeleton, graph
-
-def distance(point1, point2):
-    """Calculate Euclidean distance between two points"""
-    return math.sqrt((point1[0] - point2[0])**2 + (point1[1] - point2[1])**2 + (point1[2] - point2[2])**2)
+    # txt/ply/pcd go through the binary cache, npy/npz are read natively
+    point_cloud = read_labeled(file_path)
+    if point_cloud.labels is None:
+        raise ValueError(f"{name} has no label column")
 
-def calculate_path_length(points):
-    """Calculate total distance by traversing points based on nearest point method"""
-    if not points:
-        return 0
+    # Sorted by label once, every shoot is then a slice of the cloud
+    point_cloud = point_cloud.sort_by_label()
+    return point_cloud, point_cloud.unique_labels()
+
+def skeletonize_point_cloud(points, down_sample=SKELETON_DOWN_SAMPLE):
+    """Laplacian-contraction skeleton of one shoot (pc-skeletor)"""
+    from pc_skeletor import skeletor
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points[:, [0, 1, 2]])
+
+    n_neighbors = min(30, len(points) - 1)
+    skeletor = skeletor.Skeletonizer(point_cloud=pcd, down_sample=down_sample, debug=False)
+    laplacian_config = {
+        "MAX_LAPLACE_CONTRACTION_WEIGHT": 1024,
+        "MAX_POSITIONAL_WEIGHT": 10240,
+        "INIT_LAPLACIAN_SCALE": 100,
+        "N_NEIGHBORS": n_neighbors
+    }
+
+    try:
+        skeleton, graph = skeletor.extract(method='Laplacian', config=laplacian_config)
+    except RuntimeError as e:
+        print(f"Encountered an error: {str(e)}, retrying with fewer neighbours")
+        laplacian_config['N_NEIGHBORS'] = min(10, len(points) - 1)
+        skeleton, graph = skeletor.extract(method='Laplacian', config=laplacian_config)
+
+    return np.asarray(skeleton.points)
+
+
+def pca_skeleton(points, step=0.01):
+    """Cheap skeleton: centroids of slices along the main axis of the shoot"""
+    xyz = np.asarray(points[:, :3], dtype=np.float64)
+    centered = xyz - xyz.mean(axis=0)
+    axis = np.linalg.eigh(centered.T @ centered)[1][:, -1]
+    t = centered @ axis
+    bins = np.unique(((t - t.min()) / step).astype(np.int64), return_inverse=True)[1].ravel()
+    size = np.bincount(bins)
+    return np.column_stack([np.bincount(bins, weights=xyz[:, i]) for i in range(3)]) / size[:, None]
+
+
+def skeleton_key(points, down_sample=SKELETON_DOWN_SAMPLE):
+    """Key a shoot's skeleton on its points and the contraction parameters"""
+    h = hashlib.sha1(np.ascontiguousarray(points[:, :3], dtype=np.float64).tobytes())
+    h.update(repr(down_sample).encode())
+    return h.hexdigest()[:16]
+
+
+def _contract(conn, shoot, down_sample):
+    # Runs in its own process, sends back the skeleton or the error
+    limit_threads(1)
+    try:
+        conn.send(skeletonize_point_cloud(shoot, down_sample))
+    except Exception as e:
+        conn.send(RuntimeError(f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def contract_shoots(shoots, workers, timeout, down_sample=SKELETON_DOWN_SAMPLE):
+    """Contract shoots in up to workers processes, one process per shoot.
+
+    A shoot still running timeout seconds after its own process started is
+    killed, so a hung contraction only holds its slot until then and the
+    shoots queued behind it run in full.
 
-    total_length = 0
-    current_point = points.pop(0)  # Start with the first point
-    while points:
-        closest_point = min(points, key=lambda p: distance(current_point, p))
-        total_length += distance(current_point, closest_point)
-        current_point = closest_point
-        points.remove(closest_point)
-    return total_length
-
-# def cal_length(pcd, labels):
-#     """Calculate length for each label"""
-#     groups_length = []
-#     total_length = 0
-#
-#     for label in labels:
-#         if label in [-1]:
-#             continue
-#         print("Lengthing label: ", label)
-#         point_label = pcd[pcd[:, -1] == label]
-#
-#         skeleton, graph = skeletonize_point_cloud(point_label)
-#         list_skeleton = np.array(skeleton.points).tolist()
-#
-#         group_length = calculate_path_length(list_skeleton)
-#         groups_length.append(group_length)
-#         total_length += group_length
-#
-#     return groups_length,total_length
-
-def cal_angle(point, labels):
-    """Calculate angles for each label"""
-    z_axis = np.array([0, 0, 1])
-    angles = []
-    lengths = []
-    total_length = 0
-    total_angle = 0
-
-    for label in labels:
-        if label in [-1]:
+    Returns:
+        dict: label -> skeleton, or the exception (TimeoutError included).
+    """
+    queued, running, results = list(shoots.items()), {}, {}
+    while queued or running:
+        while queued and len(running) < workers:
+            label, shoot = queued.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_contract, args=(sender, shoot, down_sample), daemon=True)
+            process.start()
+            sender.close()
+            running[label] = (process, receiver, time.monotonic())
+
+        deadline = min(started for _, _, started in running.values()) + timeout
+        ready = wait([receiver for _, receiver, _ in running.values()], max(deadline - time.monotonic(), 0))
+        for label, (process, receiver, started) in list(running.items()):
+            if receiver in ready:
+                try:
+                    results[label] = receiver.recv()
+                except EOFError:
+                    results[label] = RuntimeError(f"contraction process exited with code {process.exitcode}")
+            elif time.monotonic() - started >= timeout:
+                process.kill()
+                results[label] = TimeoutError(f"no skeleton after {timeout} s")
+            else:
+                continue
+            process.join()
+            receiver.close()
+            del running[label]
+    return results
+
+
+def skeleton_dir(path):
+    """Skeleton cache of a scan folder, under PCD_CACHE_DIR when it is set"""
+    return os.path.join(os.environ.get("PCD_CACHE_DIR") or os.path.join(path, CACHE_DIR_NAME), "skeletons")
+
+
+@profiled("measure.skeleton")
+def skeletonize_shoots(point, cache_dir=None, workers=1, timeout=SKELETON_TIMEOUT,
+                       down_sample=SKELETON_DOWN_SAMPLE, min_points=SKELETON_MIN_POINTS):
+    """Skeletonise every shoot (label) of a tree.
+
+    Skeletons are cached as cache_dir/<skeleton_key>.npy, so re-measuring a
+    tree only contracts shoots whose points or parameters changed. Shoots
+    with fewer than min_points points, and shoots whose contraction fails or
+    takes longer than timeout seconds, get a pca_skeleton instead; fallbacks
+    are never cached, so a rerun tries the contraction again.
+
+    Args:
+        point (LabeledCloud): Shoot points, or an (n, 4) array with the label in the last column.
+        cache_dir (str): Skeleton cache, None disables caching.
+        workers (int): Worker processes, one per shoot. 1 contracts in this
+            process, where a hung contraction cannot be stopped, so timeout
+            is not applied.
+        timeout (float): Seconds of contraction allowed per shoot (workers > 1).
+
+    Returns:
+        dict: label -> (m, 3) skeleton points, noise (-1) is left out.
+    """
+    point, labels, starts, counts = split_by_label(point)
+    skeletons, pending = {}, {}
+    for label, start, count in zip(labels, starts, counts):
+        if label == -1:
             continue
-        print("Processing label: ", label)
-        point_label = point[point[:, -1] == label]
-        if len(point_label) < 5:
+        shoot = point.xyz[start:start + count]
+        if count < min_points:
+            skeletons[label] = pca_skeleton(shoot)
             continue
+        cached = os.path.join(cache_dir, skeleton_key(shoot, down_sample) + ".npy") if cache_dir else None
+        if cached and os.path.exists(cached):
+            skeletons[label] = np.load(cached)
+        else:
+            pending[label] = (shoot, cached)
+    print(f"Skeletons: {len(skeletons)} cached or small, {len(pending)} to contract")
+
+    results = {}
+    if workers == 1:
+        for label, (shoot, _) in pending.items():
+            try:
+                results[label] = skeletonize_point_cloud(shoot, down_sample)
+            except Exception as e:
+                results[label] = e
+    elif pending:
+        results = contract_shoots({label: shoot for label, (shoot, _) in pending.items()}, workers, timeout,
+                                  down_sample)
+
+    for label, (shoot, cached) in pending.items():
+        result = results[label]
+        if isinstance(result, Exception) or len(result) < 2:
+            # Not cached: the failure may be a timeout or a crash, not the shoot
+            print(f"Skeleton of label {label} failed ({type(result).__name__}), using PCA polyline")
+            skeletons[label] = pca_skeleton(shoot)
+            continue
+        if cached:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cached, result)
+        skeletons[label] = result
+
+    return skeletons
+
+
+def graph_lengths(xyz, segment, k=8, method="geodesic", step=None):
+    """Length of every segment of points from one k-NN graph.
+
+    Edges only join points of the same segment. "geodesic" follows each
+    segment from one end of its graph diameter to the other (the curved
+    length from base to tip), "mst" sums the edges of its minimum spanning
+    tree, which only suits thin skeleton-like input (calculate_path_length):
+    on a shoot surface it sums every edge of the tube.
+
+    Args:
+        xyz (np.ndarray): (n, 3) points.
+        segment (np.ndarray): (n,) segment id (0, 1, ...) of every point.
+        k (int): Neighbours per point in the graph.
+        method (str): "geodesic" or "mst".
+        step (float): Slice width of the geodesic centreline, twice the median
+            edge length by default.
+
+    Returns:
+        np.ndarray: Length per segment id.
+    """
+    n = len(xyz)
+    n_segments = int(segment.max()) + 1 if n else 0
+    if n < 2:
+        return np.zeros(n_segments)
 
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(point_label[:, :3])
+    # The segment id as a 4th coordinate, far apart, keeps neighbours of
+    # interleaved shoots from crowding out each other
+    spread = np.ptp(xyz, axis=0).max() * 10 + 1
+    lifted = np.column_stack((xyz, segment * spread))
+    k = min(k + 1, n)
+    dist, idx = cKDTree(lifted).query(lifted, k=k, workers=query_workers())
+    rows = np.repeat(np.arange(n), k - 1)
+    cols, dist = idx[:, 1:].ravel(), dist[:, 1:].ravel()
+    keep = (segment[rows] == segment[cols]) & (dist > 0)
+    rows, cols, dist = rows[keep], cols[keep], dist[keep]
+    # One undirected edge per pair: mutual neighbours list it twice, which a
+    # sparse matrix would sum into a double weight
+    graph = coo_matrix((dist, (rows, cols)), shape=(n, n)).tocsr()
+    graph = graph.maximum(graph.T).tocoo()
 
-        # Compute the oriented bounding box and length
-        obb = pcd.get_oriented_bounding_box()
-        obb_lengths = obb.extent
-        obb_length_max = max(obb_lengths)
+    if method == "mst":
+        mst = minimum_spanning_tree(graph).tocoo()
+        return np.bincount(segment[mst.row], weights=mst.data, minlength=n_segments)
+    if method != "geodesic":
+        raise ValueError(f"Unknown length method: {method}")
 
-        # Calculate the angle between the major axis and the xy plane
-        main_direction = obb.R[:, 0]  # Major axis direction
-        xy_projection = np.array([main_direction[0], main_direction[1], 0])
-        cos_theta = np.dot(main_direction, xy_projection) / (np.linalg.norm(main_direction) * np.linalg.norm(xy_projection))
-        angle = np.arccos(cos_theta)
+    # Double sweep over all components at once: a virtual root (node 0) is tied
+    # to one node per component, the farthest node from it is one end of the
+    # component, the farthest node from that end gives the length
+    n_parts, part = connected_components(graph, directed=False)
+    ends = np.unique(part, return_index=True)[1]
+    for _ in range(2):
+        rooted = coo_matrix((np.concatenate((graph.data, np.full(n_parts, 1e-12))),
+                             (np.concatenate((graph.row + 1, np.zeros(n_parts, dtype=int))),
+                              np.concatenate((graph.col + 1, ends + 1)))), shape=(n + 1, n + 1)).tocsr()
+        far = dijkstra(rooted, indices=0)[1:]
+        order = np.lexsort((-far, part))
+        starts, ends = ends, order[np.unique(part[order], return_index=True)[1]]
 
-        angle_in_degrees = np.degrees(angle)
-        angles.append(angle_in_degrees)
-        lengths.append(obb_length_max)
-        total_length += obb_length_max
-        total_angle += angle_in_degrees
+    # Graph paths zigzag across the width of the shoot, so the length is taken
+    # along a centreline: centroids of slices of equal geodesic distance from
+    # the base, joined in order and to both ends
+    if step is None:
+        step = 2 * np.median(dist)
+    level = (far / step).astype(np.int64)
+    keys, inverse = np.unique(part * (level.max() + 1) + level, return_inverse=True)
+    inverse = inverse.ravel()
+    size = np.bincount(inverse)
+    centre = np.column_stack([np.bincount(inverse, weights=xyz[:, i]) for i in range(3)]) / size[:, None]
+    centre_part = keys // (level.max() + 1)
+    same = centre_part[1:] == centre_part[:-1]
+    steps = np.linalg.norm(np.diff(centre, axis=0), axis=1)[same]
+    part_lengths = np.bincount(centre_part[1:][same], weights=steps, minlength=n_parts)
+    first = np.unique(centre_part, return_index=True)[1]
+    last = np.append(first[1:] - 1, len(keys) - 1)
+    part_lengths += np.linalg.norm(xyz[starts] - centre[first], axis=1)
+    part_lengths += np.linalg.norm(xyz[ends] - centre[last], axis=1)
 
+    # A shoot split by gaps keeps the length of its longest piece
+    lengths = np.zeros(n_segments)
+    np.maximum.at(lengths, segment[ends], part_lengths)
+    return lengths
+
+
+@profiled("measure.length")
+def shoot_lengths(point, voxel_size=LENGTH_VOXEL, k=8):
+    """Curved length of every shoot (label) of a tree.
+
+    Each shoot is reduced to voxel centroids (the graph nodes, standing in for
+    a skeleton) and measured along a k-NN graph, see graph_lengths ("geodesic").
+
+    Returns:
+        tuple: (labels, lengths), one entry per label of point.
+    """
+    point, labels, starts, counts = split_by_label(point)
+    segment = np.repeat(np.arange(len(labels)), counts)
+
+    # One voxel grid for all shoots, a voxel never mixes two labels
+    nodes, node_segment = voxel_grid(point.xyz, voxel_size, segment)
+
+    return labels, graph_lengths(nodes, node_segment, k, "geodesic", step=2 * voxel_size)
+
+
+def calculate_path_length(points):
+    """Calculate total distance through the points (length of their spanning tree)"""
+    if len(points) == 0:
+        return 0
+    points = np.asarray(points, dtype=np.float64)
+    return float(graph_lengths(points, np.zeros(len(points), dtype=int), method="mst")[0])
+
+def cal_length(pcd, labels, **skeleton_options):
+    """Calculate skeleton length for each label"""
+    skeletons = skeletonize_shoots(pcd, **skeleton_options)
+    groups_length = [calculate_path_length(skeletons[label]) for label in labels if label in skeletons]
+    return groups_length, sum(groups_length)
+
+
+def split_by_label(point):
+    """Sort points (a LabeledCloud or an (n, 4) array) by label once, every shoot is then a contiguous segment
+
+    Returns:
+        tuple: (cloud sorted by label, labels, starts, counts).
+    """
+    cloud = as_cloud(point).sort_by_label()
+    _, labels, offsets = cloud.groups()
+    return cloud, labels, offsets[:-1], np.diff(offsets)
+
+
+@profiled("measure.shoots")
+def measure_shoots(point, min_points=5, length_method="obb", **skeleton_options):
+    """Measure every shoot (label) of a tree at once with a batched PCA.
+
+    The principal axes of each shoot come from one batched eigh of the
+    per-label covariances; extents are the point spreads along those axes
+    (the oriented bounding box), the length is the largest extent and the
+    angle is the elevation of the major axis above the xy plane.
+
+    With length_method "geodesic" the length is measured along the
+    shoot instead (see shoot_lengths), which follows curved shoots;
+    "skeleton" measures contracted skeletons (see skeletonize_shoots, which
+    gets skeleton_options).
+
+    Returns:
+        pd.DataFrame: One row per shoot with label, n_points, length, angle
+        (degrees) and the three extents, noise (-1) and shoots with fewer
+        than min_points points are left out.
+    """
+    point, labels, starts, counts = split_by_label(point)
+    keep = (labels != -1) & (counts >= min_points)
+    columns = ['label', 'n_points', 'length', 'angle', 'extent_1', 'extent_2', 'extent_3']
+    if not keep.any():
+        return pd.DataFrame(columns=columns)
+
+    xyz = np.asarray(point.xyz, dtype=np.float64)
+    segment = np.repeat(np.arange(len(labels)), counts)
+    mean = np.add.reduceat(xyz, starts, axis=0) / counts[:, None]
+    centered = xyz - mean[segment]
+
+    # Batched 3x3 covariances from the 6 distinct products
+    cov = np.empty((len(labels), 3, 3))
+    for i in range(3):
+        for j in range(i, 3):
+            cov[:, i, j] = cov[:, j, i] = np.add.reduceat(centered[:, i] * centered[:, j], starts)
+    # eigh sorts eigenvalues in ascending order, the last axis is the major one
+    axes = np.linalg.eigh(cov)[1][:, :, ::-1]
+
+    extents = np.empty((len(labels), 3))
+    for j in range(3):
+        proj = np.einsum('ni,ni->n', centered, axes[segment, :, j])
+        extents[:, j] = np.maximum.reduceat(proj, starts) - np.minimum.reduceat(proj, starts)
+
+    # Angle between the major axis and its projection on the xy plane
+    major = axes[:, :, 0]
+    angles = np.degrees(np.arctan2(np.abs(major[:, 2]), np.hypot(major[:, 0], major[:, 1])))
+
+    lengths = extents.max(axis=1)
+    if length_method == "skeleton":
+        skeletons = skeletonize_shoots(point, **skeleton_options)
+        lengths = np.array([calculate_path_length(skeletons[label]) if label in skeletons else 0.0
+                            for label in labels])
+    elif length_method == "geodesic":
+        lengths = shoot_lengths(point)[1]
+    elif length_method != "obb":
+        raise ValueError(f"Unknown length method: {length_method}")
+
+    return pd.DataFrame({
+        'label': labels[keep],
+        'n_points': counts[keep],
+        'length': lengths[keep],
+        'angle': angles[keep],
+        'extent_1': extents[keep, 0],
+        'extent_2': extents[keep, 1],
+        'extent_3': extents[keep, 2],
+    })
+
+
+def cal_angle(point, labels, length_method="obb", **skeleton_options):
+    """Calculate angles and lengths for each label"""
+    shoots = measure_shoots(point, length_method=length_method, **skeleton_options)
+    shoots = shoots[shoots['label'].isin(labels)]
+    print(f"Measured {len(shoots)} shoots")
+
+    angles = shoots['angle'].tolist()
+    lengths = shoots['length'].tolist()
+    return angles, lengths, sum(angles), sum(lengths)
+
+
+def measure_one(path, filename, length_method="obb", shoot_workers=1):
+    points, labels = load_point_cloud(path, filename)
+    skeleton_options = {}
+    if length_method == "skeleton":
+        skeleton_options = {"cache_dir": skeleton_dir(path), "workers": shoot_workers}
+    angles, lengths, total_angle, total_length = cal_angle(points, labels, length_method, **skeleton_options)
     return angles, lengths, total_angle, total_length
 
+
 if __name__ == '__main__':
     path = "/Users/dylan/PCD/2023-2024/2023 New&Pruned/"
+    workers = 1  # number of trees measured in parallel
+    length_method = "obb"  # "obb" box length, "geodesic" curved length along the shoot, "skeleton"
+    shoot_workers = 1  # processes contracting the shoots of one tree ("skeleton" only)
 
     # 用于保存总长度的文件
     data = []
 
+    filenames = [f for f in os.listdir(path) if is_point_cloud(f)]
+    records = run_batch(partial(measure_one, path, length_method=length_method, shoot_workers=shoot_workers), filenames, workers,
+                        manifest=os.path.join(path, 'paras/measure_manifest.json'),
+                        prefetch=lambda f: warm(os.path.join(path, f)))
+
     with open(os.path.join(path, 'paras/parameters.json'), 'w') as file:
-        for filename in os.listdir(path):
-            if filename.endswith('txt'):
-                points, labels = load_point_cloud(path, filename)
-                angles, lengths, total_angle, total_length = cal_angle(points, labels)
-                # lengths, total_length = cal_length(points, labels)
-
-                # 将总长度写入文件
-                file.write(f"{filename[:-4]} ,{len(lengths)}, {total_length}, {total_angle}\n")
-
-                # 将每个label的长度和角度存入data列表
-                for i in range(len(lengths)):
-                    data.append({
-                        'Filename': filename[:-4] + "-" + str(i),
-                        'Box_Length': lengths[i],
-                        'Angle': angles[i]
-                    })
+        for record in records:
+            if not record['ok']:
+                continue
+            filename = os.path.splitext(record['item'])[0]
+            angles, lengths, total_angle, total_length = record['result']
+
+            # 将总长度写入文件
+            file.write(f"{filename} ,{len(lengths)}, {total_length}, {total_angle}\n")
+
+            # 将每个label的长度和角度存入data列表
+            for i in range(len(lengths)):
+                data.append({
+                    'Filename': filename + "-" + str(i),
+                    'Box_Length': lengths[i],
+                    'Angle': angles[i]
+                })
 
     # 将data列表转换为DataFrame
     df = pd.DataFrame(data)
     # 保存DataFrame到Excel文件
     df.to_excel(os.path.join(path, 'paras/len&angle.xlsx'), index=False)
-
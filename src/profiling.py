@@ -0,0 +1,156 @@
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+import functools
+from contextlib import contextmanager
+
+
+# JSON lines log of the stages (one record per stage call), profiling is off
+# while it is unset. PCD_PROFILE_TREE names one tree (file name) to run under
+# cProfile, its stats go next to the log as <tree>.prof.
+PROFILE_ENV = "PCD_PROFILE"
+PROFILE_TREE_ENV = "PCD_PROFILE_TREE"
+
+_tree = None
+# Running peak RSS (MB) of the open stages, innermost last
+_peaks = []
+
+
+def enabled():
+    return bool(os.environ.get(PROFILE_ENV))
+
+
+def _count(obj):
+    # Points of an array, a SpatialIndex, an open3d cloud or the first cloud of a tuple
+    if isinstance(obj, tuple):
+        obj = next((o for o in obj if getattr(o, "ndim", 0) == 2 or hasattr(o, "points")), None)
+    if hasattr(obj, "points"):
+        obj = obj.points
+    if isinstance(obj, str):
+        return None
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+def _reset_peak():
+    # Linux lets a process reset its RSS high-water mark, elsewhere the
+    # reported peak is the peak of the process so far
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process (since the last reset on Linux)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def _emit(record):
+    with open(os.environ[PROFILE_ENV], "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+@contextmanager
+def stage(name, points_in=None):
+    """Time a stage of the current tree, set record["points_out"] inside the block.
+
+    Stages nest: the high-water mark is reset when a stage starts, so the
+    peak an outer stage reached before it is kept, and an outer stage reports
+    the largest of its own reading and the peaks of its inner stages.
+    """
+    record = {"tree": _tree, "stage": name, "points_in": points_in, "points_out": None}
+    if not enabled():
+        yield record
+        return
+    if _peaks:
+        _peaks[-1] = max(_peaks[-1], peak_rss_mb())
+    _reset_peak()
+    _peaks.append(0.0)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        peak = max(_peaks.pop(), peak_rss_mb())
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], peak)
+        record.update(wall_s=round(time.perf_counter() - wall, 4), cpu_s=round(time.process_time() - cpu, 4),
+                      peak_rss_mb=round(peak, 1), pid=os.getpid())
+        _emit(record)
+
+
+def profiled(name):
+    """Decorator recording a function as a stage, points in/out from its first argument and result"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with stage(name, _count(args[0]) if args else None) as record:
+                result = func(*args, **kwargs)
+                record["points_out"] = _count(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def run_tree(func, item):
+    """Run func(item) with the stages attributed to item, under cProfile if it is PCD_PROFILE_TREE"""
+    global _tree
+    _tree = item
+    try:
+        if enabled() and os.environ.get(PROFILE_TREE_ENV) == str(item):
+            profiler = cProfile.Profile()
+            try:
+                with stage("total"):
+                    return profiler.runcall(func, item)
+            finally:
+                profiler.dump_stats(os.path.join(os.path.dirname(os.path.abspath(os.environ[PROFILE_ENV])), f"{item}.prof"))
+        with stage("total"):
+            return func(item)
+    finally:
+        _tree = None
+
+
+def summarize(log_path, csv_path=None):
+    """Total the JSON lines log per stage, optionally write them to a CSV.
+
+    Returns:
+        list: One dict per stage with calls, wall_s, cpu_s, max peak_rss_mb,
+        points_in and points_out, slowest stage first.
+    """
+    totals = {}
+    with open(log_path) as f:
+        for line in f:
+            record = json.loads(line)
+            row = totals.setdefault(record["stage"], {"stage": record["stage"], "calls": 0, "wall_s": 0.0,
+                                                       "cpu_s": 0.0, "peak_rss_mb": 0.0, "points_in": 0, "points_out": 0})
+            row["calls"] += 1
+            row["wall_s"] += record["wall_s"]
+            row["cpu_s"] += record["cpu_s"]
+            row["peak_rss_mb"] = max(row["peak_rss_mb"], record["peak_rss_mb"])
+            row["points_in"] += record["points_in"] or 0
+            row["points_out"] += record["points_out"] or 0
+
+    rows = sorted(totals.values(), key=lambda r: r["wall_s"], reverse=True)
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["stage"])
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
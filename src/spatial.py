@@ -0,0 +1,440 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+# Threads of the KD-tree queries of this process, -1 uses all cores. cKDTree
+# ignores the BLAS/OpenMP caps, so batch.limit_threads sets it to the threads
+# of a batch worker
+QUERY_WORKERS = -1
+
+
+def query_workers(workers=None):
+    """Threads of a KD-tree query: workers, or QUERY_WORKERS when it is None"""
+    return QUERY_WORKERS if workers is None else workers
+
+
+def voxel_keys(points, origin, voxel_size):
+    # Pack the 3 integer voxel coordinates into one int64 (21 bits per axis)
+    idx = np.floor((points - origin) / voxel_size).astype(np.int64)
+    if idx.size and (idx.min() < 0 or idx.max() >= 1 << 21):
+        raise ValueError("voxel grid too large, increase voxel_size or split the scan.")
+    return (idx[:, 0] << 42) | (idx[:, 1] << 21) | idx[:, 2]
+
+
+def _reduce_voxels(keys, sums, counts):
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    merged = np.column_stack([np.bincount(inverse, weights=sums[:, i], minlength=len(uniq)) for i in range(3)])
+    return uniq, merged, np.bincount(inverse, weights=counts, minlength=len(uniq))
+
+
+def voxel_downsample_chunks(chunks, voxel_size, origin, return_keys=False):
+    """Voxel-grid downsampling (voxel centroids) over an iterable of xyz chunks.
+
+    Per-voxel sums are accumulated chunk by chunk, so memory depends on the
+    chunk size and the number of occupied voxels, not on the number of points.
+    With ``origin = min_bound - voxel_size / 2`` the grid matches Open3D's
+    ``voxel_down_sample`` (output order differs). With return_keys the sorted
+    voxel_keys of the centroids are returned as well, so that points can be
+    mapped to their voxel block by block.
+    """
+    origin = np.asarray(origin, dtype=np.float64)
+    parts, merged = [], None
+    for chunk in chunks:
+        xyz = np.asarray(chunk[:, :3], dtype=np.float64)
+        if len(xyz) == 0:
+            continue
+        parts.append(_reduce_voxels(voxel_keys(xyz, origin, voxel_size), xyz, np.ones(len(xyz))))
+
+        # Merge partial results once they outgrow the merged grid (amortised cost)
+        pending = sum(len(p[0]) for p in parts)
+        if merged is None or pending > len(merged[0]):
+            if merged is not None:
+                parts.append(merged)
+            merged = _reduce_voxels(*(np.concatenate(p) for p in zip(*parts)))
+            parts = []
+
+    if merged is None:
+        empty = np.empty((0, 3))
+        return (empty, np.empty(0, dtype=np.int64)) if return_keys else empty
+    if parts:
+        merged = _reduce_voxels(*(np.concatenate(p) for p in zip(*parts + [merged])))
+    keys, sums, counts = merged
+    return (sums / counts[:, None], keys) if return_keys else sums / counts[:, None]
+
+
+def iter_blocks(points, block_size=1_000_000):
+    """Yield consecutive row blocks of an array (or memmap)"""
+    for start in range(0, len(points), block_size):
+        yield points[start:start + block_size]
+
+
+def min_bound(points, block_size=1_000_000):
+    """Blockwise minimum of the xyz columns (float64), keeps memmapped scans on disk"""
+    bound = np.min([np.min(block[:, :3], axis=0) for block in iter_blocks(points, block_size)], axis=0)
+    return bound.astype(np.float64)
+
+
+def coordinates(points):
+    """xyz rows of an array, a memmap, a .npy path, a SpatialIndex or a LabeledCloud (labels dropped)"""
+    return points.points if isinstance(points, SpatialIndex) else getattr(points, "xyz", points)
+
+
+def _sor_inliers(avg, std_ratio):
+    # open3d keeps points whose mean k-NN distance is below mean + std_ratio * std
+    valid = avg > 0
+    mean = avg[valid].mean()
+    std = np.sqrt(((avg[valid] - mean) ** 2).sum() / max(valid.sum() - 1, 1))
+    return valid & (avg < mean + std_ratio * std)
+
+
+class SpatialIndex:
+    """KD-tree of one cloud, built once and queried by every stage.
+
+    SOR, mean point spacing, difference filtering and clustering all go through
+    the same index. k-NN distances of the cloud to itself are cached, so SOR
+    (nb neighbours) and the spacing (2nd neighbour) share one query.
+    select(mask) returns a view over a subset that keeps using the parent's
+    tree: its queries fetch a few more neighbours and skip the excluded points.
+    """
+
+    def __init__(self, points, workers=None, tree=None):
+        # tree: a cKDTree built earlier over the same points (e.g. unpickled)
+        self._points = np.asarray(coordinates(points)[:, :3], dtype=np.float64)
+        self.workers = workers
+        self._tree = tree
+        self._knn = None
+        self._valid = None
+        self._selected = None
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self._points)
+        return self._tree
+
+    @property
+    def points(self):
+        """Points of the index (of the selection for a view)"""
+        if self._valid is None:
+            return self._points
+        if self._selected is None:
+            self._selected = self._points[self._valid[:-1]]
+        return self._selected
+
+    def select(self, mask):
+        """View over points[mask] that shares this index's KD-tree"""
+        view = SpatialIndex.__new__(SpatialIndex)
+        view.__dict__.update(self.__dict__)
+        view._knn, view._selected = None, None
+        # One extra False entry for the "missing neighbour" index n of cKDTree
+        valid = np.zeros(len(self._points) + 1, dtype=bool)
+        valid[np.flatnonzero(self._valid[:-1])[mask] if self._valid is not None else np.flatnonzero(mask)] = True
+        view._valid = valid
+        view._tree = self.tree
+        return view
+
+    def query(self, queries, k, distance_upper_bound=np.inf):
+        """Sorted distances (m, k) from queries to their k nearest points of the index"""
+        queries = np.asarray(queries[:, :3], dtype=np.float64)
+        if self._valid is None:
+            dist, _ = self.tree.query(queries, k=k, distance_upper_bound=distance_upper_bound,
+                                      workers=query_workers(self.workers))
+            return dist.reshape(len(queries), k)
+
+        n = len(self._points)
+        out = np.full((len(queries), k), np.inf)
+        rows, extra = np.arange(len(queries)), k
+        while rows.size:
+            kk = min(k + extra, n)
+            dist, idx = self.tree.query(queries[rows], k=kk, distance_upper_bound=distance_upper_bound,
+                                        workers=query_workers(self.workers))
+            dist, idx = dist.reshape(len(rows), kk), idx.reshape(len(rows), kk)
+            # Excluded points move to the back, the order of the others is kept
+            valid = self._valid[idx]
+            order = np.argsort(~valid, axis=1, kind="stable")
+            dist = np.take_along_axis(np.where(valid, dist, np.inf), order, axis=1)[:, :k]
+            # Rows short of valid neighbours while further points may still be valid
+            short = (valid.sum(axis=1) < k) & (idx[:, -1] < n) & (kk < n)
+            out[rows[~short], :dist.shape[1]] = dist[~short]
+            rows, extra = rows[short], extra * 4
+        return out
+
+    def knn(self, k):
+        """Cached k-NN distances of the points to themselves (the point included)"""
+        if self._knn is None or self._knn.shape[1] < k:
+            self._knn = self.query(self.points, k).astype(np.float32)
+        return self._knn[:, :k]
+
+    def mean_spacing(self):
+        """Mean distance of every point to its nearest neighbour"""
+        return float(self.knn(2)[:, 1].mean())
+
+    def sor_mask(self, nb_neighbors, std_ratio):
+        """Inlier mask of open3d's statistical outlier removal, from the cached k-NN"""
+        return _sor_inliers(self.knn(nb_neighbors).mean(axis=1, dtype=np.float64), std_ratio)
+
+
+def as_index(points, workers=None):
+    """Wrap an array into a SpatialIndex querying on workers threads, pass existing indexes through"""
+    return points if isinstance(points, SpatialIndex) else SpatialIndex(points, workers)
+
+
+def kth_distance(A, B, k, max_threshold=np.inf, block_size=1_000_000):
+    """Distance from every point of B to its k-th nearest point of A.
+
+    The query stops at max_threshold (inf beyond it) and runs block by block
+    over B on all cores of the index, so only one block of the (m, k)
+    distance/index arrays exists at a time and one column is kept.
+    """
+    index = as_index(A)
+    B = coordinates(B)
+    # Just above the largest threshold, so that ties compare like the plain distance
+    bound = np.nextafter(max_threshold, np.inf)
+    kth = np.empty(len(B))
+    for start in range(0, len(B), block_size):
+        block = B[start:start + block_size]
+        kth[start:start + len(block)] = index.query(block, k=k, distance_upper_bound=bound)[:, -1]
+    return kth
+
+
+def _append(path, array):
+    with open(path, "ab") as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+
+
+def _spill(directory, name, slab, xyz, rows=None):
+    # Append the points of every slab to <name><slab>.xyz (and their rows to .idx)
+    order = np.argsort(slab, kind="stable")
+    slabs, starts = np.unique(slab[order], return_index=True)
+    for s, part in zip(slabs, np.split(order, starts[1:])):
+        _append(os.path.join(directory, f"{name}{s}.xyz"), xyz[part])
+        if rows is not None:
+            _append(os.path.join(directory, f"{name}{s}.idx"), rows[part])
+    return slabs
+
+
+def _slab_kth(directory, s, k, bound):
+    # k-th distance of the points of B in slab s to the points of A spilled with it
+    b = np.fromfile(os.path.join(directory, f"b{s}.xyz")).reshape(-1, 3)
+    a_path = os.path.join(directory, f"a{s}.xyz")
+    a = np.fromfile(a_path).reshape(-1, 3) if os.path.exists(a_path) else np.empty((0, 3))
+    if len(a) < k:
+        # Fewer than k points of A in reach: the k-th is beyond the bound, like in the full query
+        return np.full(len(b), np.inf)
+    dist, _ = cKDTree(a).query(b, k=k, distance_upper_bound=bound)
+    return dist.reshape(len(b), k)[:, -1]
+
+
+def kth_distance_tiled(A, B, k, max_threshold, tile_size=1.0, workers=1, block_size=1_000_000):
+    """kth_distance computed slab by slab along x, optionally over a process pool.
+
+    Every slab of B only needs the points of A within max_threshold of it.
+    One streaming pass per cloud buckets the points into per-slab spill files
+    (B with its row numbers, A into every slab it can reach), then each slab
+    builds a KD-tree over its points of A alone, and the results equal the
+    full query exactly. Memory depends on block_size and on the largest slab,
+    not on the scans; the spill files take about 32 bytes per point of B and
+    24 per point of A and slab. A and B may be arrays, memmaps (read once, in
+    order), SpatialIndex objects, LabeledClouds or .npy paths.
+    """
+    A, B = coordinates(A), coordinates(B)
+    A = np.load(A, mmap_mode="r") if isinstance(A, str) else A
+    B = np.load(B, mmap_mode="r") if isinstance(B, str) else B
+    bound = np.nextafter(max_threshold, np.inf)
+    kth = np.full(len(B), np.inf)
+    if len(B) == 0 or len(A) == 0:
+        return kth
+
+    x0 = min_bound(B, block_size)[0]
+    x1 = max(float(np.max(block[:, 0])) for block in iter_blocks(B, block_size))
+    n_slabs = int((x1 - x0) // tile_size) + 1
+    # A little slack: points of A near the edge of a reach go to one slab too many, never too few
+    reach = bound + tile_size * 1e-9
+
+    def slab_of(x):
+        return np.floor(np.clip((x - x0) / tile_size, -1, n_slabs)).astype(np.int64)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filled = set()
+        for start in range(0, len(B), block_size):
+            xyz = np.asarray(B[start:start + block_size, :3], dtype=np.float64)
+            slab = np.minimum(slab_of(xyz[:, 0]), n_slabs - 1)
+            filled.update(_spill(directory, "b", slab, xyz, np.arange(start, start + len(xyz))).tolist())
+        for block in iter_blocks(A, block_size):
+            xyz = np.asarray(block[:, :3], dtype=np.float64)
+            first = np.maximum(slab_of(xyz[:, 0] - reach), 0)
+            last = np.minimum(slab_of(xyz[:, 0] + reach), n_slabs - 1)
+            # Points within reach of several slabs are spilled once per slab
+            for shift in range(int((last - first).max(initial=-1)) + 1):
+                rows = np.flatnonzero(first + shift <= last)
+                _spill(directory, "a", first[rows] + shift, xyz[rows])
+
+        def rows_of(s):
+            return np.fromfile(os.path.join(directory, f"b{s}.idx"), dtype=np.int64)
+
+        slabs = sorted(filled)
+        if workers == 1:
+            for s in slabs:
+                kth[rows_of(s)] = _slab_kth(directory, s, k, bound)
+            return kth
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_slab_kth, directory, s, k, bound): s for s in slabs}
+            for future in as_completed(futures):
+                kth[rows_of(futures[future])] = future.result()
+    return kth
+
+
+def difference_masks(A, B, thresholds, op=">", k=4, block_size=1_000_000, tile_size=None, workers=1):
+    """Masks of the points of B whose k nearest points of A are all farther
+    (op ">", new points) or all closer (op "<", retained points) than each
+    threshold, from one query.
+
+    All k neighbours are farther than t iff the nearest one is, so ">" only
+    asks for 1 neighbour; all are closer iff the k-th is. With tile_size the
+    query runs slab by slab (kth_distance_tiled) on workers processes, with
+    the same result.
+
+    Returns:
+        dict: threshold -> boolean mask over B.
+    """
+    thresholds = list(thresholds)
+    if op not in (">", "<"):
+        raise ValueError(f"Unknown comparison: {op}")
+    k = 1 if op == ">" else k
+    if tile_size:
+        kth = kth_distance_tiled(A, B, k, max(thresholds), tile_size, workers, block_size)
+    else:
+        kth = kth_distance(A, B, k, max(thresholds), block_size)
+    if op == ">":
+        return {t: kth > t for t in thresholds}
+    return {t: kth < t for t in thresholds}
+
+
+def _cell_offsets(cell_size, eps):
+    # Half of the neighbouring cell offsets whose closest points can be within eps
+    reach = int(np.ceil(eps / cell_size))
+    r = np.arange(-reach, reach + 1)
+    offsets = np.stack(np.meshgrid(r, r, r, indexing="ij"), axis=-1).reshape(-1, 3)
+    gap = np.maximum(np.abs(offsets) - 1, 0) * cell_size
+    keep = np.sqrt((gap ** 2).sum(axis=1)) <= eps
+    positive = np.array([tuple(o) > (0, 0, 0) for o in offsets])
+    return offsets[keep & positive]
+
+
+def grid_dbscan(points, eps, min_samples, workers=None, block_size=200_000):
+    """DBSCAN with a cell-based neighbour search, clusters match sklearn's DBSCAN.
+
+    Core points are found with bounded k-NN queries (no neighbourhood lists
+    are stored). Core points are then binned into cells of side
+    eps / sqrt(3): core points sharing a cell are always connected, so only
+    pairs of neighbouring cells need a test, which stops as soon as one pair
+    of core points within eps is found. Border points join the cluster of
+    their nearest core point (sklearn picks the first cluster reaching them,
+    so border points between two clusters may differ); cluster ids follow the
+    lowest core point index of each cluster, as in sklearn.
+
+    Args:
+        points (np.array): Point cloud of shape (n, 3) or its SpatialIndex.
+        eps (float): Neighbourhood radius.
+        min_samples (int): Neighbours (the point itself included) of a core point.
+        workers (int): Threads for the KD-tree queries, -1 uses all cores,
+            None QUERY_WORKERS. An existing SpatialIndex keeps its own workers
+            for the core point queries.
+        block_size (int): Number of queries per block, bounds the memory.
+
+    Returns:
+        np.array: Cluster label of every point, -1 for noise.
+    """
+    index = as_index(points, workers)
+    workers = query_workers(workers)
+    points = index.points
+    radius = np.nextafter(eps, np.inf)  # neighbours at exactly eps count, as in sklearn
+    labels = np.full(len(points), -1, dtype=np.int64)
+
+    # A point is core when its min_samples-th neighbour lies within eps, so a
+    # bounded k-NN query replaces counting the whole neighbourhood
+    k = max(int(min_samples), 2)
+    is_core = np.zeros(len(points), dtype=bool)
+    has_neighbour = np.zeros(len(points), dtype=bool)
+    for start in range(0, len(points), block_size):
+        dist = index.query(points[start:start + block_size], k, radius)
+        is_core[start:start + block_size] = np.isfinite(dist[:, min_samples - 1]) if min_samples >= 1 else True
+        has_neighbour[start:start + block_size] = np.isfinite(dist[:, 1])
+    core_idx = np.flatnonzero(is_core)
+    if core_idx.size == 0:
+        return labels
+    core = points[core_idx]
+
+    # Bin core points into cells and sort them by cell
+    cell_size = eps / np.sqrt(3)
+    cell_xyz = np.floor((core - core.min(axis=0)) / cell_size).astype(np.int64)
+    cell_keys = (cell_xyz[:, 0] << 42) | (cell_xyz[:, 1] << 21) | cell_xyz[:, 2]
+    keys, cell_id, cell_sizes = np.unique(cell_keys, return_inverse=True, return_counts=True)
+    cell_id = cell_id.ravel()
+    order = np.argsort(cell_id, kind="stable")
+    cell_start = np.concatenate(([0], np.cumsum(cell_sizes)[:-1]))
+    cell_coords = np.stack((keys >> 42, (keys >> 21) & ((1 << 21) - 1), keys & ((1 << 21) - 1)), axis=1)
+
+    # Candidate pairs of occupied neighbouring cells
+    c1, c2 = [], []
+    for offset in _cell_offsets(cell_size, eps):
+        target = cell_coords + offset
+        valid = np.all(target >= 0, axis=1)
+        target_keys = (target[:, 0] << 42) | (target[:, 1] << 21) | target[:, 2]
+        pos = np.clip(np.searchsorted(keys, target_keys), 0, len(keys) - 1)
+        found = valid & (keys[pos] == target_keys)
+        c1.append(np.flatnonzero(found))
+        c2.append(pos[found])
+    c1, c2 = np.concatenate(c1), np.concatenate(c2)
+
+    # Test the pairs with the points of c1 in rounds of growing rank; a 4th
+    # coordinate (cell id * 2 eps) restricts each k=1 query to the cell c2.
+    core_4d = cKDTree(np.column_stack((core, cell_id * 2.0 * eps)))
+    linked = np.zeros(len(c1), dtype=bool)
+    pending = np.arange(len(c1))
+    lo, hi = 0, 1
+    while pending.size:
+        take = np.clip(cell_sizes[c1[pending]] - lo, 0, hi - lo)
+        pair = np.repeat(pending, take)
+        rank = lo + np.arange(len(pair)) - np.repeat(np.cumsum(take) - take, take)
+        for start in range(0, len(pair), block_size):
+            p = pair[start:start + block_size]
+            src = order[cell_start[c1[p]] + rank[start:start + block_size]]
+            query = np.column_stack((core[src], c2[p] * 2.0 * eps))
+            dist, _ = core_4d.query(query, k=1, distance_upper_bound=radius, workers=workers)
+            linked[p[np.isfinite(dist)]] = True
+        # Drop linked pairs and pairs whose first cell has no points left to test
+        pending = pending[~linked[pending] & (cell_sizes[c1[pending]] > hi)]
+        lo, hi = hi, hi * 2
+
+    # Connected components of the cell graph are the clusters
+    graph = coo_matrix((np.ones(linked.sum()), (c1[linked], c2[linked])), shape=(len(keys), len(keys)))
+    _, cell_component = connected_components(graph, directed=False)
+    core_labels = cell_component[cell_id]
+
+    # Number clusters by their lowest core point index, like sklearn (which
+    # grows clusters from core points in index order)
+    first = np.full(cell_component.max() + 1, len(points))
+    np.minimum.at(first, core_labels, core_idx)
+    new_id = np.empty_like(first)
+    new_id[np.argsort(first, kind="stable")] = np.arange(len(first))
+    core_labels = new_id[core_labels]
+
+    # Border points take the cluster of their nearest core point within eps
+    border = np.flatnonzero(~is_core & has_neighbour)
+    if border.size:
+        core_tree = cKDTree(core)
+        dist, nearest = core_tree.query(points[border], k=1, distance_upper_bound=radius, workers=workers)
+        hit = np.isfinite(dist)
+        labels[border[hit]] = core_labels[nearest[hit]]
+    labels[core_idx] = core_labels
+    return labels
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from utils import CACHE_DIR_NAME
+from batch import write_later
+
+
+# Stage outputs are kept under PCD_CACHE_DIR/stages (or ~/.pcd_cache/stages)
+# until the cache grows past this size, then the least recently used go first
+STAGE_CACHE_BYTES = 20 * 2**30
+
+_digests = {}
+
+
+def file_digest(file_path):
+    """Content hash of a file, computed once per path, mtime and size"""
+    st = os.stat(file_path)
+    memo = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+    if memo not in _digests:
+        h = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                h.update(block)
+        _digests[memo] = h.hexdigest()
+    return _digests[memo]
+
+
+def stage_key(stage, inputs, params):
+    """Key a stage run on its name, the content of its input files and its parameters"""
+    h = hashlib.sha1(stage.encode())
+    for file_path in inputs:
+        h.update(file_digest(file_path).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return f"{stage}-{h.hexdigest()[:20]}"
+
+
+class StageCache:
+    """Size-bounded, least-recently-used store of stage outputs on disk.
+
+    Every entry is a directory named by its stage_key holding output files or
+    .npy arrays. A hit touches the entry, every store evicts the entries used
+    least recently until the cache fits in max_bytes. Parallel workers evict
+    without a lock, so an entry that disappears while it is read is a miss.
+    """
+
+    def __init__(self, root=None, max_bytes=STAGE_CACHE_BYTES):
+        if root is None:
+            root = os.path.join(os.environ.get("PCD_CACHE_DIR") or os.path.join(os.path.expanduser("~"), CACHE_DIR_NAME), "stages")
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def _hit(self, key):
+        entry = self._entry(key)
+        now = time.time()
+        try:
+            os.utime(entry, (now, now))
+        except FileNotFoundError:
+            return None
+        return entry if os.path.isdir(entry) else None
+
+    def _store(self, key, fill):
+        # Filled under a temporary name and renamed, so that parallel workers
+        # never see half an entry
+        entry = self._entry(key)
+        tmp = f"{entry}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            fill(tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            # Another worker stored the same entry first
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def get_files(self, key, outputs):
+        """Copy the cached files of key to outputs, return False on a miss
+        (including an entry that lacks one of the outputs)"""
+        entry = self._hit(key)
+        if entry is None:
+            return False
+        members = [os.path.join(entry, f"{i}{os.path.splitext(out)[1]}") for i, out in enumerate(outputs)]
+        try:
+            for member, out in zip(members, outputs):
+                shutil.copyfile(member, out)
+        except FileNotFoundError:
+            # Evicted by another worker (or stored without this output): the
+            # stage runs and overwrites whatever was copied
+            return False
+        return True
+
+    def put_files(self, key, outputs):
+        self._store(key, lambda tmp: [shutil.copyfile(out, os.path.join(tmp, f"{i}{os.path.splitext(out)[1]}"))
+                                      for i, out in enumerate(outputs)])
+
+    def get_arrays(self, key):
+        """Cached arrays of key (memory-mapped) or None on a miss"""
+        entry = self._hit(key)
+        if entry is None:
+            return None
+        try:
+            n = len(os.listdir(entry))
+            return tuple(np.load(os.path.join(entry, f"{i}.npy"), mmap_mode="r") for i in range(n))
+        except FileNotFoundError:
+            return None
+
+    def put_arrays(self, key, arrays):
+        self._store(key, lambda tmp: [np.save(os.path.join(tmp, f"{i}.npy"), np.asarray(a))
+                                      for i, a in enumerate(arrays)])
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if not os.path.isdir(entry) or ".tmp" in name:
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except FileNotFoundError:
+                # Evicted by another worker meanwhile
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def as_cache(cache):
+    """True: the default cache, False/None: no caching, or a StageCache"""
+    if cache is True:
+        return StageCache()
+    return cache or None
+
+
+def run_stage(cache, stage, inputs, params, outputs, func):
+    """Run func() to write outputs, unless a run with the same inputs and params is cached"""
+    cache = as_cache(cache)
+    if cache is None:
+        func()
+        return
+    key = stage_key(stage, inputs, params)
+    if cache.get_files(key, outputs):
+        print(f"{stage}: reused cached {', '.join(os.path.basename(out) for out in outputs)}")
+        return
+    func()
+    # Queued after the writes of func, so the outputs exist when they are stored
+    write_later(cache.put_files, key, outputs)
+
+
+def cached_arrays(cache, stage, inputs, params, func):
+    """Return func() (a tuple of arrays), from the cache when inputs and params are unchanged"""
+    cache = as_cache(cache)
+    if cache is None:
+        return func()
+    key = stage_key(stage, inputs, params)
+    arrays = cache.get_arrays(key)
+    if arrays is not None:
+        print(f"{stage}: reused cached arrays of {', '.join(os.path.basename(f) for f in inputs)}")
+        return arrays
+    arrays = func()
+    cache.put_arrays(key, arrays)
+    return arrays
@@ -0,0 +1,173 @@
+import os
+import json
+import pickle
+from functools import partial
+import numpy as np
+from scipy.spatial import cKDTree
+from utils import read_point_cloud, is_point_cloud, LabeledCloud
+from spatial import SpatialIndex, difference_masks, grid_dbscan
+from downsampling import voxel_grid
+from stage_cache import file_digest, cached_arrays
+from Registration import register_trees, transform_by_H
+from batch import run_batch
+from profiling import profiled
+
+
+# Every season of a tree is stored downsampled and SOR filtered like the
+# inputs of the difference filter, in the frame of the tree's first season
+VOXEL_SIZE = 0.001
+SOR = (20, 2.0)
+
+# Difference threshold (x * registration RMSE) and DBSCAN min_samples of the shoot queries
+RMSE = 0.009
+MIN_SAMPLES = 20
+
+
+class TemporalStore:
+    """Per-tree store of registered seasons (epochs).
+
+    <root>/<tree>/ holds, per epoch, the cloud in the frame of the first
+    epoch (<epoch>.npy, float32), the pickled KD-tree over it
+    (<epoch>.kdtree) and epochs.json: the epochs in the order they were
+    added, with their source digest and transform chain. A new season is
+    registered against the latest epoch only, and a query between two epochs
+    loads those two and nothing in between.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, tree):
+        return os.path.join(self.root, tree)
+
+    def epochs(self, tree):
+        """Records of the stored epochs of a tree, oldest first"""
+        path = os.path.join(self._dir(tree), "epochs.json")
+        if not os.path.isfile(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def _record(self, tree, epoch):
+        for record in self.epochs(tree):
+            if record["epoch"] == epoch:
+                return record
+        raise KeyError(f"{tree} has no epoch {epoch}")
+
+    def cloud_path(self, tree, epoch):
+        return os.path.join(self._dir(tree), f"{epoch}.npy")
+
+    def cloud(self, tree, epoch):
+        """Registered cloud of an epoch (memory-mapped)"""
+        return np.load(self.cloud_path(tree, epoch), mmap_mode="r")
+
+    def transform(self, tree, epoch):
+        """4x4 transform of the raw scan of an epoch into the frame of the first epoch"""
+        return np.array(self._record(tree, epoch)["H"])
+
+    def index(self, tree, epoch):
+        """SpatialIndex of an epoch, reusing its stored KD-tree"""
+        with open(os.path.join(self._dir(tree), f"{epoch}.kdtree"), "rb") as f:
+            kdtree = pickle.load(f)
+        return SpatialIndex(kdtree.data, tree=kdtree)
+
+    @profiled("temporal.add")
+    def add_epoch(self, tree, epoch, file_path, icp_method="pyramid"):
+        """Register the scan of a new season against the latest epoch and store it.
+
+        Adding an epoch again from the same file does nothing; epochs are
+        expected in time order, so only the latest one can be replaced.
+
+        Returns:
+            dict: The record of the epoch.
+        """
+        records = self.epochs(tree)
+        digest = file_digest(file_path)
+        for i, record in enumerate(records):
+            if record["epoch"] != epoch:
+                continue
+            if record["digest"] == digest:
+                print(f"{tree}: epoch {epoch} is up to date")
+                return record
+            if i != len(records) - 1:
+                raise ValueError(f"{tree}: epoch {epoch} is not the latest one, it cannot be replaced")
+            records = records[:-1]
+
+        # Same preprocessing as denoise_one: voxel centroids, then SOR
+        xyz, _ = read_point_cloud(file_path)
+        index = SpatialIndex(voxel_grid(xyz, VOXEL_SIZE)[0])
+        cloud = index.points[index.sor_mask(*SOR)]
+
+        if records:
+            # Only the latest epoch is read, it is already in the frame of the first
+            parent = records[-1]["epoch"]
+            H, _, _ = register_trees(np.array(self.cloud(tree, parent), dtype=np.float64), cloud, icp_method)
+            H_parent = np.linalg.solve(np.array(records[-1]["H"]), H)
+        else:
+            parent, H, H_parent = None, np.eye(4), np.eye(4)
+        cloud = transform_by_H(cloud, H, dtype=np.float32)
+
+        directory = self._dir(tree)
+        os.makedirs(directory, exist_ok=True)
+        np.save(self.cloud_path(tree, epoch), cloud)
+        with open(os.path.join(directory, f"{epoch}.kdtree"), "wb") as f:
+            pickle.dump(cKDTree(cloud.astype(np.float64)), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        record = {"epoch": epoch, "source": os.path.abspath(file_path), "digest": digest, "points": len(cloud),
+                  "parent": parent, "H_parent": H_parent.tolist(), "H": H.tolist(),
+                  "voxel_size": VOXEL_SIZE, "sor": SOR}
+        tmp = os.path.join(directory, f"epochs.json.tmp{os.getpid()}")
+        with open(tmp, "w") as f:
+            json.dump(records + [record], f, indent=2)
+        os.replace(tmp, os.path.join(directory, "epochs.json"))
+        return record
+
+    @profiled("temporal.changes")
+    def changes(self, tree, i, j, kind="added", x=3, min_samples=MIN_SAMPLES, cache=True):
+        """Shoots added (in epoch j, not in epoch i) or removed (in i, not in j).
+
+        The difference filter and DBSCAN of get_branch, run on the two stored
+        epochs with the KD-tree of the reference one. Results are kept in the
+        stage cache, keyed on the two epoch files.
+
+        Returns:
+            LabeledCloud: The changed points, labelled per shoot (-1 noise).
+        """
+        if kind not in ("added", "removed"):
+            raise ValueError(f"Unknown change: {kind}")
+        reference, other = (i, j) if kind == "added" else (j, i)
+        threshold = x * RMSE
+
+        def compute():
+            points = np.asarray(self.cloud(tree, other), dtype=np.float64)
+            changed = points[difference_masks(self.index(tree, reference), points, [threshold], op=">")[threshold]]
+            labels = grid_dbscan(changed, threshold, min_samples) if len(changed) else np.empty(0, dtype=int)
+            return changed, labels
+
+        inputs = [self.cloud_path(tree, reference), self.cloud_path(tree, other)]
+        params = {"kind": kind, "threshold": threshold, "min_samples": min_samples}
+        return LabeledCloud(*cached_arrays(cache, "temporal", inputs, params, compute))
+
+
+def _add_one(root, season_path, epoch, icp_method, filename):
+    return TemporalStore(root).add_epoch(os.path.splitext(filename)[0], epoch, os.path.join(season_path, filename),
+                                         icp_method)
+
+
+def add_season(root, season_path, epoch, workers=1, threads=1, icp_method="pyramid"):
+    """Add every tree scan of a season folder to the store as epoch, trees in parallel"""
+    filenames = [f for f in os.listdir(season_path) if is_point_cloud(f)]
+    job = partial(_add_one, root, season_path, epoch, icp_method)
+    return run_batch(job, filenames, workers, threads, manifest=os.path.join(season_path, f"temporal_{epoch}_manifest.json"))
+
+
+if __name__ == "__main__":
+
+    store = "/Users/dylan/PCD/Temporal/store/"
+
+    # One folder per season, the same tree file names every year; only the new season is registered
+    add_season(store, "/Users/dylan/PCD/Temporal/2024AP/", "2024", workers=4)
+    add_season(store, "/Users/dylan/PCD/Temporal/2025/", "2025", workers=4)
+
+    # Shoots grown between two seasons, without touching the seasons in between
+    shoots = TemporalStore(store).changes("tree1", "2024", "2025", kind="added")
@@ -0,0 +1,235 @@
+import os
+from functools import partial
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from utils import read_point_cloud, save_point_cloud, is_point_cloud
+from spatial import iter_blocks
+from batch import run_batch
+from profiling import profiled
+
+
+# Trunk bases are density peaks of the points TRUNK_BAND (m) above the local
+# ground (lowest point of every GROUND_CELL square), gridded at BASE_CELL
+TRUNK_BAND = (0.2, 0.5)
+BASE_CELL = 0.05
+GROUND_CELL = 1.0
+
+# Closest two trunks of a row (m), fewest band points of a trunk and the
+# overlap (m) every tile takes from its neighbours
+TREE_SPACING = 0.8
+MIN_BASE_POINTS = 50
+TILE_OVERLAP = 0.3
+
+# Extension of the tiles: ".txt" (%.8f text), ".ply", ".npy" or ".npz" (binary)
+OUT_EXT = ".txt"
+BLOCK_SIZE = 1_000_000
+
+
+def _bounds(xyz, block_size=BLOCK_SIZE):
+    blocks = [(np.min(b[:, :3], axis=0), np.max(b[:, :3], axis=0)) for b in iter_blocks(xyz, block_size)]
+    return np.min([b[0] for b in blocks], axis=0), np.max([b[1] for b in blocks], axis=0)
+
+
+def _cells(xy, origin, cell, shape):
+    ij = np.floor((xy - origin) / cell).astype(np.int64)
+    return np.ravel_multi_index((np.clip(ij[:, 0], 0, shape[0] - 1), np.clip(ij[:, 1], 0, shape[1] - 1)), shape)
+
+
+@profiled("tiling.bases")
+def find_trunk_bases(xyz, band=TRUNK_BAND, cell=BASE_CELL, ground_cell=GROUND_CELL, spacing=TREE_SPACING,
+                     min_points=MIN_BASE_POINTS, block_size=BLOCK_SIZE):
+    """xy of the trunk bases of a row scan, streamed block by block.
+
+    The gridded form of the slices of get_trunk: a trunk is a narrow column
+    that stays dense low above the ground, where the canopy spreads out. The
+    points band metres above the ground of their ground_cell are counted per
+    cell, summed over 3 x 3 cells, and every maximum of a spacing-wide window
+    with at least min_points points is a trunk.
+
+    Args:
+        xyz (np.ndarray): (n, >=3) points, e.g. a memmap of the binary cache.
+
+    Returns:
+        np.ndarray: (m, 2) trunk bases.
+    """
+    lo, hi = _bounds(xyz, block_size)
+    ground_shape = tuple(np.floor((hi[:2] - lo[:2]) / ground_cell).astype(int) + 1)
+    shape = tuple(np.floor((hi[:2] - lo[:2]) / cell).astype(int) + 1)
+
+    ground = np.full(np.prod(ground_shape), np.inf)
+    for block in iter_blocks(xyz, block_size):
+        np.minimum.at(ground, _cells(block[:, :2], lo[:2], ground_cell, ground_shape), block[:, 2])
+
+    counts = np.zeros(np.prod(shape))
+    for block in iter_blocks(xyz, block_size):
+        height = block[:, 2] - ground[_cells(block[:, :2], lo[:2], ground_cell, ground_shape)]
+        in_band = block[(height >= band[0]) & (height < band[1])]
+        counts += np.bincount(_cells(in_band[:, :2], lo[:2], cell, shape), minlength=len(counts))
+
+    density = ndimage.uniform_filter(counts.reshape(shape), size=3, mode="constant") * 9
+    window = 2 * int(spacing / cell / 2) + 1
+    peaks = (density == ndimage.maximum_filter(density, size=window, mode="constant")) & (density >= min_points)
+    # A plateau of equal maxima is one trunk
+    regions, n = ndimage.label(peaks)
+    if n == 0:
+        return np.empty((0, 2))
+    centres = np.array(ndimage.center_of_mass(peaks, regions, range(1, n + 1)))
+    return lo[:2] + (centres + 0.5) * cell
+
+
+def row_axis(bases):
+    """Unit direction of a row (principal axis of its trunk bases), pointing to +x or +y"""
+    if len(bases) < 2:
+        return np.array([1.0, 0.0])
+    centered = bases - bases.mean(axis=0)
+    axis = np.linalg.eigh(centered.T @ centered)[1][:, -1]
+    return axis if axis[np.argmax(np.abs(axis))] > 0 else -axis
+
+
+def tile_bounds(u, overlap=TILE_OVERLAP):
+    """(lo, hi) along the row of the tiles of sorted trunk positions u, split half way between trunks"""
+    mids = (u[1:] + u[:-1]) / 2
+    return np.r_[-np.inf, mids] - overlap, np.r_[mids, np.inf] + overlap
+
+
+@profiled("tiling.split")
+def split_row(file_path, out_files, origin, axis, lo, hi, block_size=BLOCK_SIZE):
+    """Stream a row scan into one file per tile, the points with lo <= u < hi along axis.
+
+    Points of an overlap go to both tiles. Labels, when the scan has them,
+    are kept. Tiles whose out file is None are cut but not written.
+    """
+    xyz, labels = read_point_cloud(file_path)
+    columns = 3 if labels is None else 4
+    raws = [None if out is None else f"{out}.{os.getpid()}.raw" for out in out_files]
+    handles = [None if raw is None else open(raw, "wb") for raw in raws]
+    try:
+        for start in range(0, len(xyz), block_size):
+            block = np.asarray(xyz[start:start + block_size], dtype=np.float32)
+            if labels is not None:
+                block = np.column_stack((block, labels[start:start + block_size]))
+            u = (block[:, :2] - origin) @ axis
+            # Tiles first .. last hold a point, one or two of them unless the overlap is huge
+            first = np.searchsorted(hi, u, side="right")
+            last = np.searchsorted(lo, u, side="right") - 1
+            for shift in range(int((last - first).max(initial=-1)) + 1):
+                tile = first + shift
+                rows = np.flatnonzero(tile <= last)
+                rows = rows[np.argsort(tile[rows], kind="stable")]
+                tiles, starts = np.unique(tile[rows], return_index=True)
+                for t, part in zip(tiles, np.split(rows, starts[1:])):
+                    if handles[t] is not None:
+                        handles[t].write(np.ascontiguousarray(block[part]).tobytes())
+        for f in handles:
+            if f is not None:
+                f.close()
+
+        for raw, out in zip(raws, out_files):
+            if out is None:
+                continue
+            data = np.fromfile(raw, dtype=np.float32).reshape(-1, columns)
+            save_point_cloud(out, data[:, :3], data[:, 3] if columns == 4 else None)
+    finally:
+        for f, raw in zip(handles, raws):
+            if f is None:
+                continue
+            f.close()
+            if os.path.exists(raw):
+                os.remove(raw)
+
+
+def match_bases(uA, uB, tolerance):
+    """Pair the trunks of two scans of a row from their positions along it.
+
+    The scans are in different frames, so uB is shifted (and possibly
+    reversed) onto uA: the shift is the one that pairs the most trunks within
+    tolerance, then every trunk is paired with its mutual nearest neighbour.
+
+    Returns:
+        tuple: (index into uA, index into uB) of the pairs, ordered along uA.
+    """
+    if len(uA) == 0 or len(uB) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    best = (0, 0.0, 1, 0.0)
+    for sign in (1, -1):
+        tree = cKDTree((sign * uB)[:, None])
+        # Every pairing of one AP with one BP trunk proposes a shift
+        for shift in np.unique(np.round((uA[:, None] - sign * uB[None, :]).ravel(), 3)):
+            gaps = tree.query((uA - shift)[:, None])[0]
+            close = gaps <= tolerance
+            score = (close.sum(), -gaps[close].sum() if close.any() else 0.0)
+            if score > best[:2]:
+                best = (*score, sign, shift)
+    _, _, sign, shift = best
+
+    v = sign * uB + shift
+    dist = np.abs(uA[:, None] - v[None, :])
+    a_to_b, b_to_a = dist.argmin(axis=1), dist.argmin(axis=0)
+    ia = np.flatnonzero((b_to_a[a_to_b] == np.arange(len(uA))) & (dist.min(axis=1) <= tolerance))
+    return ia, a_to_b[ia]
+
+
+def _row_frame(xyz, **options):
+    bases = find_trunk_bases(xyz, **options)
+    origin = bases.mean(axis=0) if len(bases) else np.zeros(2)
+    axis = row_axis(bases)
+    u = (bases - origin) @ axis
+    order = np.argsort(u)
+    return bases[order], u[order], origin, axis
+
+
+def tile_row(AP_row, BP_row, AP_out, BP_out, overlap=TILE_OVERLAP, ext=OUT_EXT, **options):
+    """Cut the AP and BP scans of one row into per-tree tiles with matching names.
+
+    Every scan is split half way between all of its trunks. Trunks found in
+    both scans give the tiles <row>_<k>, numbered along the row; align_tree
+    and get_branch(es) then pair them by file name. A trunk found in one scan
+    only still bounds its neighbours' tiles, its own tile is reported and
+    left out.
+
+    Returns:
+        list: File names of the tiles.
+    """
+    row = os.path.splitext(os.path.basename(AP_row))[0]
+    frames = [_row_frame(read_point_cloud(path)[0], **options) for path in (AP_row, BP_row)]
+    (A_bases, uA, A_origin, A_axis), (B_bases, uB, B_origin, B_axis) = frames
+    ia, ib = match_bases(uA, uB, options.get("spacing", TREE_SPACING) / 2)
+    print(f"{row}: {len(uA)} AP and {len(uB)} BP trunks, {len(ia)} matched")
+    if len(ia) == 0:
+        return []
+
+    names = [f"{row}_{k:03d}{ext}" for k in range(len(ia))]
+    for path, out, u, idx, origin, axis in ((AP_row, AP_out, uA, ia, A_origin, A_axis),
+                                            (BP_row, BP_out, uB, ib, B_origin, B_axis)):
+        # u is sorted, idx maps the k-th matched tree to its trunk (in reverse
+        # order for a BP row scanned the other way round)
+        out_files = [None] * len(u)
+        for k, i in enumerate(idx):
+            out_files[i] = os.path.join(out, names[k])
+        lo, hi = tile_bounds(u, overlap)
+        split_row(path, out_files, origin, axis, lo, hi)
+    return names
+
+
+def tile_rows(AP, BP, AP_out, BP_out, workers=1, threads=1, **options):
+    """Tile every row scan found in both AP and BP, rows in parallel"""
+    os.makedirs(AP_out, exist_ok=True)
+    os.makedirs(BP_out, exist_ok=True)
+    filenames = [f for f in os.listdir(AP) if is_point_cloud(f) and os.path.isfile(os.path.join(BP, f))]
+    job = partial(_tile_one, AP, BP, AP_out, BP_out, **options)
+    return run_batch(job, filenames, workers, threads, manifest=os.path.join(AP_out, "tile_manifest.json"))
+
+
+def _tile_one(AP, BP, AP_out, BP_out, filename, **options):
+    return tile_row(os.path.join(AP, filename), os.path.join(BP, filename), AP_out, BP_out, **options)
+
+
+if __name__ == "__main__":
+
+    # Whole-row scans, one file per row with the same name in both folders
+    AP_rows = "/Users/dylan/PCD/After prun rows/"
+    BP_rows = "/Users/dylan/PCD/Before prun rows/"
+
+    # The tiles are the per-tree inputs of align_tree and get_branch
+    tile_rows(AP_rows, BP_rows, "/Users/dylan/PCD/After prun/", "/Users/dylan/PCD/Before prun/", workers=4)
@@ -0,0 +1,427 @@
+import io
+import os
+import re
+import hashlib
+import itertools
+import numpy as np
+import open3d as o3d
+
+
+# Binary copies of the ASCII scans live next to the source file unless
+# PCD_CACHE_DIR points somewhere else (e.g. a local SSD on the workers).
+CACHE_DIR_NAME = ".pcd_cache"
+
+# Formats understood by read_point_cloud / save_point_cloud
+POINT_CLOUD_EXTS = (".txt", ".ply", ".pcd", ".npy", ".npz")
+
+
+def cache_key(file_path):
+    """Key a scan on its absolute path, mtime and size"""
+    st = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}|{st.st_mtime_ns}|{st.st_size}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def cache_paths(file_path, cache_dir=None):
+    """Return the (xyz, label) .npy paths of the cache entry for a scan"""
+    if cache_dir is None:
+        cache_dir = os.environ.get("PCD_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(file_path)), CACHE_DIR_NAME)
+    base = os.path.join(cache_dir, f"{os.path.basename(file_path)}.{cache_key(file_path)}")
+    return base + ".xyz.npy", base + ".label.npy"
+
+
+def _drop_stale(file_path, xyz_path):
+    # Remove entries of the same scan built from an older mtime/size
+    cache_dir = os.path.dirname(xyz_path)
+    pattern = re.compile(re.escape(os.path.basename(file_path)) + r"\.[0-9a-f]{16}\.(xyz|label)\.npy$")
+    current = os.path.basename(xyz_path)[:-len("xyz.npy")]
+    for other in os.listdir(cache_dir):
+        if pattern.match(other) and not other.startswith(current):
+            os.remove(os.path.join(cache_dir, other))
+
+
+def _read_header(f, fmt):
+    """Parse a .ply/.pcd header, return (encoding, numpy dtype, n_points) of the vertex block"""
+    ply_types = {"char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+                 "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+                 "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+                 "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"}
+    fields, n_points, encoding = [], 0, None
+
+    if fmt == "ply":
+        element = None
+        while True:
+            line = f.readline().decode("ascii", "ignore").strip()
+            if not line or line == "end_header":
+                break
+            words = line.split()
+            if words[0] == "format":
+                encoding = words[1]
+            elif words[0] == "element":
+                element = words[1]
+                if element == "vertex":
+                    n_points = int(words[2])
+                elif n_points == 0:
+                    # vertices are not the first element, offsets are unknown
+                    encoding = None
+            elif words[0] == "property" and element == "vertex":
+                if words[1] == "list":
+                    encoding = None
+                else:
+                    fields.append((words[2], ply_types[words[1]]))
+        order = ">" if encoding == "binary_big_endian" else "<"
+        encoding = {"ascii": "ascii", "binary_little_endian": "binary",
+                    "binary_big_endian": "binary"}.get(encoding)
+    else:
+        names, sizes, types, counts = [], [], [], []
+        while True:
+            line = f.readline().decode("ascii", "ignore").strip()
+            if not line:
+                break
+            words = line.split()
+            key = words[0].upper()
+            if key == "FIELDS":
+                names = words[1:]
+            elif key == "SIZE":
+                sizes = [int(w) for w in words[1:]]
+            elif key == "TYPE":
+                types = words[1:]
+            elif key == "COUNT":
+                counts = [int(w) for w in words[1:]]
+            elif key == "POINTS":
+                n_points = int(words[1])
+            elif key == "DATA":
+                encoding = words[1] if words[1] in ("ascii", "binary") else None
+                break
+        counts = counts or [1] * len(names)
+        order = "<"
+        for name, size, t, count in zip(names, sizes, types, counts):
+            kind = {"F": "f", "I": "i", "U": "u"}[t] + str(size)
+            fields.extend([(name if count == 1 else f"{name}_{c}", kind) for c in range(count)])
+
+    dtype = np.dtype([(name, order + kind) for name, kind in fields])
+    return encoding, dtype, n_points
+
+
+def _columns(names):
+    # xyz first, then a label field when the file has one
+    cols = [names.index(c) for c in ("x", "y", "z")]
+    for label in ("label", "scalar_label", "class", "classification"):
+        if label in names:
+            cols.append(names.index(label))
+            break
+    return cols
+
+
+def _iter_text(f, chunk_size, usecols=None):
+    while True:
+        lines = list(itertools.islice(f, chunk_size))
+        if not lines:
+            break
+        chunk = np.loadtxt(lines, dtype=np.float32, ndmin=2)
+        if chunk.size == 0:
+            continue
+        yield chunk if usecols is None else chunk[:, usecols]
+
+
+def iter_chunks(file_path, chunk_size=1_000_000):
+    """Stream a .txt/.ply/.pcd point cloud in fixed-size float32 chunks.
+
+    Text files yield every column (x y z [... label]); .ply/.pcd files yield
+    x y z plus a label field when present. Peak memory depends on chunk_size,
+    not on the size of the scan.
+    """
+    lower = file_path.lower()
+    if lower.endswith(".txt"):
+        with open(file_path) as f:
+            yield from _iter_text(f, chunk_size)
+        return
+    if lower.endswith((".npy", ".npz")):
+        xyz, labels = read_point_cloud(file_path)
+        for start in range(0, len(xyz), chunk_size):
+            chunk = np.asarray(xyz[start:start + chunk_size], dtype=np.float32)
+            if labels is not None:
+                chunk = np.column_stack((chunk, labels[start:start + chunk_size]))
+            yield chunk
+        return
+    if not lower.endswith((".ply", ".pcd")):
+        raise ValueError("Unsupported file format")
+
+    with open(file_path, "rb") as f:
+        encoding, dtype, n_points = _read_header(f, "ply" if lower.endswith(".ply") else "pcd")
+        offset = f.tell()
+        cols = _columns(list(dtype.names)) if encoding else None
+        if encoding == "ascii":
+            text = io.TextIOWrapper(f, encoding="ascii")
+            yield from _iter_text(itertools.islice(text, n_points), chunk_size, cols)
+            return
+
+    if encoding == "binary":
+        data = np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=(n_points,))
+        names = [dtype.names[c] for c in cols]
+        for start in range(0, n_points, chunk_size):
+            block = data[start:start + chunk_size]
+            yield np.column_stack([block[name].astype(np.float32) for name in names])
+        return
+
+    # binary_compressed PCD, list properties, ...: let open3d decode the whole file
+    pcd = o3d.io.read_point_cloud(file_path)
+    points = np.asarray(pcd.points, dtype=np.float32)
+    for start in range(0, len(points), chunk_size):
+        yield points[start:start + chunk_size]
+
+
+def _write_npy(path, raw_path, dtype, shape, out_dtype=None):
+    # Wrap a raw column file into .npy, converting in blocks if needed
+    tmp = f"{path}.{os.getpid()}.tmp"
+    out_dtype = np.dtype(out_dtype or dtype)
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * np.dtype(dtype).itemsize
+    with open(raw_path, "rb") as src, open(tmp, "wb") as dst:
+        np.lib.format.write_array_header_1_0(dst, {"descr": np.lib.format.dtype_to_descr(out_dtype),
+                                                  "fortran_order": False, "shape": shape})
+        while True:
+            block = src.read(row_bytes * 1_000_000)
+            if not block:
+                break
+            if out_dtype == dtype:
+                dst.write(block)
+            else:
+                dst.write(np.frombuffer(block, dtype=dtype).astype(out_dtype).tobytes())
+    os.remove(raw_path)
+    os.replace(tmp, path)
+
+
+def build_cache(file_path, cache_dir=None, chunk_size=1_000_000):
+    """Convert a scan once into float32 xyz plus a label column, chunk by chunk"""
+    xyz_path, label_path = cache_paths(file_path, cache_dir)
+    os.makedirs(os.path.dirname(xyz_path), exist_ok=True)
+    print("Building binary cache: ", os.path.basename(file_path))
+
+    xyz_raw, label_raw = f"{xyz_path}.{os.getpid()}.raw", f"{label_path}.{os.getpid()}.raw"
+    n, has_label, integral = 0, False, True
+    with open(xyz_raw, "wb") as fx, open(label_raw, "wb") as fl:
+        for chunk in iter_chunks(file_path, chunk_size):
+            fx.write(np.ascontiguousarray(chunk[:, :3]).tobytes())
+            if chunk.shape[1] > 3:
+                has_label = True
+                labels = np.ascontiguousarray(chunk[:, -1])
+                integral = integral and np.array_equal(labels, np.round(labels))
+                fl.write(labels.tobytes())
+            n += len(chunk)
+
+    if has_label:
+        # DBSCAN labels are written as floats, keep them as integers when possible
+        _write_npy(label_path, label_raw, np.float32, (n,), np.int32 if integral else None)
+    else:
+        os.remove(label_raw)
+    # The xyz file is written last, its presence marks a complete entry
+    _write_npy(xyz_path, xyz_raw, np.float32, (n, 3))
+    _drop_stale(file_path, xyz_path)
+
+
+def load_cached(file_path, cache_dir=None):
+    """Open a scan from the binary cache, converting the source file on first use.
+
+    Args:
+        file_path (str): Path of the point cloud (.txt with x y z [... label], .ply or .pcd).
+        cache_dir (str): Optional cache directory, defaults to PCD_CACHE_DIR or
+            a ``.pcd_cache`` folder next to the scan.
+
+    Returns:
+        tuple: (xyz, labels) as read-only float32 / int32 memmaps. labels is
+        None when the file only holds coordinates.
+    """
+    xyz_path, label_path = cache_paths(file_path, cache_dir)
+    if not os.path.isfile(xyz_path):
+        build_cache(file_path, cache_dir)
+
+    xyz = np.load(xyz_path, mmap_mode="r")
+    labels = np.load(label_path, mmap_mode="r") if os.path.isfile(label_path) else None
+    return xyz, labels
+
+
+def is_point_cloud(filename):
+    return filename.lower().endswith(POINT_CLOUD_EXTS)
+
+
+def read_point_cloud(file_path):
+    """Read xyz and (optional) labels of a .txt/.ply/.pcd/.npy/.npz file.
+
+    .npy files are memory-mapped directly, .npz files are decompressed, text
+    and .ply/.pcd files go through the binary cache.
+    """
+    lower = file_path.lower()
+    if lower.endswith(".npy"):
+        data = np.load(file_path, mmap_mode="r")
+        return data[:, :3], (data[:, -1] if data.shape[1] > 3 else None)
+    elif lower.endswith(".npz"):
+        with np.load(file_path) as data:
+            return data["xyz"], (data["label"] if "label" in data.files else None)
+    elif lower.endswith((".txt", ".ply", ".pcd")):
+        return load_cached(file_path)
+    else:
+        raise ValueError("Unsupported file format")
+
+
+def warm(*file_paths, block_size=1 << 24):
+    """Read scans ahead: convert them into the binary cache and pull the
+    files a later read_point_cloud opens into the OS page cache"""
+    for file_path in file_paths:
+        paths = [file_path]
+        if file_path.lower().endswith((".txt", ".ply", ".pcd")):
+            load_cached(file_path)
+            paths = [p for p in cache_paths(file_path) if os.path.isfile(p)]
+        for path in paths:
+            with open(path, "rb") as f:
+                while f.read(block_size):
+                    pass
+
+
+def _as_labels(labels):
+    # int32 labels; float columns (text files) must hold whole numbers
+    labels = np.asarray(labels)
+    if labels.dtype.kind == "f":
+        if not np.array_equal(labels, np.round(labels)):
+            raise ValueError("labels must be integers")
+    elif labels.dtype.kind not in "iu":
+        raise ValueError(f"labels must be integers, not {labels.dtype}")
+    if labels.size and (labels.min() < np.iinfo(np.int32).min or labels.max() > np.iinfo(np.int32).max):
+        raise ValueError("labels out of the int32 range")
+    return labels.astype(np.int32, copy=False)
+
+
+class LabeledCloud:
+    """Point cloud with float32 xyz and int32 labels (or no labels).
+
+    Points can be grouped by label once, CSR-style: a sort order, the sorted
+    unique labels and their offsets. In a cloud sorted by label every shoot is
+    a zero-copy slice. np.asarray(cloud) gives the xyz, so array consumers
+    never take the label for a coordinate; save_point_cloud writes both.
+    """
+
+    def __init__(self, xyz, labels=None):
+        self.xyz = np.asarray(xyz[:, :3], dtype=np.float32)
+        self.labels = None if labels is None else _as_labels(labels)
+        self._groups = None
+
+    @classmethod
+    def from_array(cls, array):
+        """Cloud of an (n, 3) array or an (n, 4) array with the label in the last column"""
+        array = np.asarray(array)
+        return cls(array[:, :3], array[:, -1] if array.shape[1] > 3 else None)
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.xyz if dtype is None else self.xyz.astype(dtype)
+
+    @property
+    def points(self):
+        return self.xyz
+
+    def select(self, mask):
+        """Cloud of the points selected by a mask or index array"""
+        return LabeledCloud(self.xyz[mask], None if self.labels is None else self.labels[mask])
+
+    def groups(self):
+        """(order, labels, offsets): the points of labels[i] are order[offsets[i]:offsets[i + 1]],
+        order is None when the cloud is already sorted by label"""
+        if self.labels is None:
+            raise ValueError("the cloud has no labels")
+        if self._groups is None:
+            order, labels = None, self.labels
+            if np.any(labels[1:] < labels[:-1]):
+                order = np.argsort(labels, kind="stable")
+                labels = labels[order]
+            unique, starts = np.unique(labels, return_index=True)
+            self._groups = (order, unique, np.append(starts, len(labels)))
+        return self._groups
+
+    def unique_labels(self):
+        return self.groups()[1]
+
+    def sort_by_label(self):
+        """The same cloud sorted by label (self if it already is)"""
+        order, labels, offsets = self.groups()
+        if order is None:
+            return self
+        cloud = LabeledCloud(self.xyz[order], self.labels[order])
+        cloud._groups = (None, labels, offsets)
+        return cloud
+
+    def shoots(self):
+        """Yield (label, cloud) per label, views when the cloud is sorted by label"""
+        order, labels, offsets = self.groups()
+        for label, start, end in zip(labels, offsets[:-1], offsets[1:]):
+            rows = slice(start, end) if order is None else order[start:end]
+            yield label, LabeledCloud(self.xyz[rows], self.labels[rows])
+
+
+def as_cloud(points):
+    """LabeledCloud of an array (label in the 4th column), clouds pass through"""
+    return points if isinstance(points, LabeledCloud) else LabeledCloud.from_array(points)
+
+
+def read_labeled(file_path):
+    """Read a point cloud file into a LabeledCloud"""
+    return LabeledCloud(*read_point_cloud(file_path))
+
+
+def _write_ply(file_path, xyz, labels, block_size=1_000_000):
+    fields = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {len(xyz)}",
+              "property float x", "property float y", "property float z"]
+    if labels is not None:
+        fields.append(("label", "<i4"))
+        header.append("property int label")
+    header.append("end_header")
+
+    with open(file_path, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        for start in range(0, len(xyz), block_size):
+            block = xyz[start:start + block_size]
+            rows = np.empty(len(block), dtype=fields)
+            rows["x"], rows["y"], rows["z"] = block[:, 0], block[:, 1], block[:, 2]
+            if labels is not None:
+                rows["label"] = labels[start:start + block_size]
+            f.write(rows.tobytes())
+
+
+def save_point_cloud(file_path, points, labels=None):
+    """Write xyz (and optional labels) in the format given by the extension.
+
+    Args:
+        file_path (str): Output path. ``.txt`` keeps the ``%.8f`` columns,
+            ``.ply`` is binary little-endian (float xyz, int label), ``.npy``
+            is one float32 (n, 3|4) array and ``.npz`` stores compressed xyz
+            and label arrays.
+        points (np.array): Point cloud of shape (n, 3), or (n, 4) with the
+            label in the last column (the layout of the text outputs), or a
+            LabeledCloud.
+        labels (np.array): Optional labels, overrides the 4th column.
+    """
+    if isinstance(points, LabeledCloud):
+        points, labels = points.xyz, points.labels if labels is None else labels
+    points = np.asarray(points)
+    if labels is None and points.shape[1] > 3:
+        labels = points[:, -1]
+    xyz = points[:, :3]
+    if labels is not None:
+        labels = np.asarray(labels)
+
+    lower = file_path.lower()
+    if lower.endswith(".txt"):
+        np.savetxt(file_path, xyz if labels is None else np.column_stack((xyz, labels)), fmt='%.8f')
+    elif lower.endswith(".ply"):
+        _write_ply(file_path, xyz, labels)
+    elif lower.endswith(".npy"):
+        data = xyz if labels is None else np.column_stack((xyz, labels))
+        np.save(file_path, data.astype(np.float32))
+    elif lower.endswith(".npz"):
+        arrays = {"xyz": xyz.astype(np.float32)}
+        if labels is not None:
+            arrays["label"] = labels.astype(np.int32)
+        np.savez_compressed(file_path, **arrays)
+    else:
+        raise ValueError("Unsupported file format")
@@ -0,0 +1,158 @@
+import os
+import sys
+import zlib
+import queue
+import struct
+import threading
+from multiprocessing import util
+import numpy as np
+
+
+# How the QA views are shown: "window" (blocking open3d windows), "png"
+# (off-screen snapshots written by a background thread) or "off". Unset, it is
+# "window" when a display is available and "png" otherwise.
+VIS_ENV = "PCD_VIS"
+
+# Snapshot size (pixels of the panel height), points drawn per cloud and
+# pending snapshots before the caller waits for the renderer
+SNAPSHOT_SIZE = 600
+SNAPSHOT_POINTS = 300_000
+SNAPSHOT_QUEUE = 8
+
+BACKGROUND = (255, 255, 255)
+
+_queue = None
+_pid = None
+_lock = threading.Lock()
+
+
+def mode():
+    value = os.environ.get(VIS_ENV)
+    if value:
+        if value not in ("window", "png", "off"):
+            raise ValueError(f"Unknown {VIS_ENV} mode: {value}")
+        return value
+    has_display = sys.platform in ("darwin", "win32") or os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
+    return "window" if has_display else "png"
+
+
+def write_png(file_path, image):
+    """Write an (h, w, 3) uint8 image as an RGB PNG (zlib, no imaging library needed)"""
+    h, w, _ = image.shape
+    # Every row starts with filter type 0
+    raw = np.concatenate((np.zeros((h, 1), dtype=np.uint8), image.reshape(h, -1)), axis=1).tobytes()
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    with open(file_path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))
+                + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+
+def _panel(xyz, rgb, axes, depth, lo, scale, shape, point_size):
+    # Orthographic view along one axis, the point nearest to the viewer wins each pixel
+    h, w = shape
+    order = np.argsort(depth, kind="stable")
+    col = ((xyz[order, axes[0]] - lo[axes[0]]) * scale).astype(np.int64)
+    row = h - 1 - ((xyz[order, axes[1]] - lo[axes[1]]) * scale).astype(np.int64)
+    # (point, offset) pixels, row-major so that nearer points come first
+    rows = row[:, None] + np.repeat(np.arange(point_size), point_size)[None, :]
+    cols = col[:, None] + np.tile(np.arange(point_size), point_size)[None, :]
+    inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+    pixel = (rows * w + cols)[inside]
+    source = np.broadcast_to(order[:, None], rows.shape)[inside]
+    pixel, first = np.unique(pixel, return_index=True)
+
+    image = np.empty((h * w, 3), dtype=np.uint8)
+    image[:] = BACKGROUND
+    image[pixel] = rgb[source[first]]
+    return image.reshape(h, w, 3)
+
+
+def rasterize(clouds, colors, size=SNAPSHOT_SIZE, point_size=2):
+    """Front (x-z) and side (y-z) orthographic views of clouds, side by side.
+
+    Args:
+        clouds (list): (n, >=3) arrays, drawn in one frame.
+        colors (list): One RGB colour per cloud, floats in [0, 1].
+        size (int): Height of the views in pixels.
+
+    Returns:
+        np.ndarray: (size, width, 3) uint8 image.
+    """
+    xyz = np.vstack([np.asarray(c[:, :3], dtype=np.float64) for c in clouds])
+    rgb = np.repeat(np.round(np.asarray(colors) * 255).astype(np.uint8), [len(c) for c in clouds], axis=0)
+    lo, hi = xyz.min(axis=0), xyz.max(axis=0)
+    scale = (size - point_size) / max(hi[2] - lo[2], 1e-9)
+    # Very wide clouds are scaled down to fit a 4:1 panel
+    scale = min(scale, 4 * size / max(hi[0] - lo[0], hi[1] - lo[1], 1e-9))
+
+    front = _panel(xyz, rgb, (0, 2), xyz[:, 1], lo, scale, (size, int((hi[0] - lo[0]) * scale) + point_size), point_size)
+    side = _panel(xyz, rgb, (1, 2), -xyz[:, 0], lo, scale, (size, int((hi[1] - lo[1]) * scale) + point_size), point_size)
+    gap = np.full((size, 4, 3), 128, dtype=np.uint8)
+    return np.concatenate((front, gap, side), axis=1)
+
+
+def _render():
+    while True:
+        clouds, colors, file_path = _queue.get()
+        try:
+            os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+            write_png(file_path, rasterize(clouds, colors))
+        except Exception as e:
+            # A failed snapshot never fails the tree
+            print(f"Snapshot failed: {file_path}: {e}")
+        finally:
+            _queue.task_done()
+
+
+def _start():
+    # One renderer thread per process (forked workers start their own)
+    global _queue, _pid
+    with _lock:
+        if _pid != os.getpid():
+            _queue, _pid = queue.Queue(maxsize=SNAPSHOT_QUEUE), os.getpid()
+            threading.Thread(target=_render, daemon=True).start()
+            # Pool workers skip atexit, multiprocessing's exit hook still runs
+            util.Finalize(None, flush, exitpriority=100)
+
+
+def snapshot(clouds, colors, file_path, max_points=SNAPSHOT_POINTS):
+    """Queue a PNG of the clouds for the background renderer and return at once.
+
+    Every cloud is subsampled to max_points, the copies are what the renderer
+    draws, so the caller may change its arrays right away.
+    """
+    rng = np.random.default_rng(0)
+    clouds = [np.array(c[:, :3]) if len(c) <= max_points
+              else np.asarray(c[np.sort(rng.choice(len(c), max_points, replace=False)), :3]) for c in clouds]
+    _start()
+    _queue.put((clouds, colors, file_path))
+
+
+def flush():
+    """Wait until every queued snapshot is written"""
+    if _queue is not None and _pid == os.getpid():
+        _queue.join()
+
+
+def show(clouds, colors, name, png_prefix=None):
+    """Show clouds as the current mode says: an open3d window, a PNG snapshot
+    <png_prefix>_<name>.png, or nothing"""
+    current = mode()
+    if current == "off":
+        return
+    if current == "png":
+        if png_prefix is not None:
+            snapshot(clouds, colors, f"{png_prefix}_{name.lower().replace(' ', '_')}.png")
+        return
+
+    import open3d as o3d
+    geometries = []
+    for cloud, color in zip(clouds, colors):
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(np.asarray(cloud[:, :3], dtype=np.float64))
+        pcd.paint_uniform_color(color)
+        geometries.append(pcd)
+    o3d.visualization.draw_geometries(geometries, window_name=name)